@@ -0,0 +1,138 @@
+import json
+import struct
+import hashlib
+import numpy as np
+from atomic_file import atomic_write
+from feature_store import FeatureStore
+
+# every model artifact starts with these bytes
+MAGIC = b'\x93FACEID'
+
+# version of the file layout written by save_artifact()
+VERSION = 1
+
+# arrays start at multiples of this many bytes so they can be memory-mapped
+ALIGN = 64
+
+# number of rows hashed at a time by data_hash()
+CHUNK_SIZE = 1024
+
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def save_artifact(path, arrays, metadata):
+    """Saves named numpy arrays and a metadata dictionary to one file
+
+    The file holds MAGIC, the format version, the length of a JSON header
+    and the header itself, followed by the raw bytes of every array. The
+    header contains the metadata and the dtype, shape and offset of each
+    array. The arrays are aligned so that load_artifact() can memory-map
+    them instead of reading them.
+
+    The file is written to a temporary path first and then renamed, so
+    a model that is being loaded is never half-written.
+    """
+
+    arrays = {name: np.atleast_1d(np.ascontiguousarray(array))
+              for name, array in arrays.items()}
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str,
+                        'shape': list(array.shape),
+                        'offset': offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({'version': VERSION,
+                         'metadata': metadata,
+                         'arrays': layout}).encode()
+    prefix = MAGIC + struct.pack('<BI', VERSION, len(header))
+    data_start = _align(len(prefix) + len(header))
+
+    with atomic_write(path) as f:
+        f.write(prefix)
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+
+
+def load_artifact(path, mmap=True):
+    """Loads the arrays and metadata saved by save_artifact()
+
+    With mmap = True the arrays are read-only memory maps of the file, so
+    loading is instant and only the parts that are used get read from disk.
+
+    Returns a dictionary of arrays and the metadata dictionary
+    """
+
+    with open(path, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 5)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a model artifact.')
+
+        version, header_length = struct.unpack('<BI', prefix[len(MAGIC):])
+        if version > VERSION:
+            raise ValueError(f'{path} has format version {version}, '
+                             f'only versions up to {VERSION} are supported.')
+
+        header = json.loads(f.read(header_length))
+        data_start = _align(len(prefix) + header_length)
+
+        arrays = {}
+        for name, info in header['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            shape = tuple(info['shape'])
+            offset = data_start + info['offset']
+
+            if mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r',
+                                         offset=offset, shape=shape)
+            else:
+                f.seek(offset)
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+    return arrays, header['metadata']
+
+
+def quantize_int8(w):
+    """Quantizes weights to int8 with one float32 scale per column
+
+    Returns the int8 weights q and the scales, where q * scale ~= w
+    """
+    w = np.asarray(w, dtype=np.float32)
+    scale = np.max(np.abs(w), axis=0, keepdims=True) / 127
+    scale[scale == 0] = 1
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def dequantize_int8(q, scale):
+    """Converts int8 weights from quantize_int8() back to float32"""
+    return q.astype(np.float32) * scale
+
+
+def data_hash(X, Y=None):
+    """Returns a short hash identifying a training dataset
+
+    X is a FeatureStore or an array; the hash covers its raw values (and
+    the labels Y), so a model can record exactly what it was trained on.
+    """
+    h = hashlib.sha1()
+
+    if isinstance(X, FeatureStore):
+        # hash the stored uint8 pixels rather than the scaled floats
+        rows = np.arange(X.shape[0]) if X.indices is None else X.indices
+        for start in range(0, len(rows), CHUNK_SIZE):
+            h.update(np.take(X.data, rows[start:start + CHUNK_SIZE], axis=0).tobytes())
+    else:
+        h.update(np.ascontiguousarray(X).tobytes())
+
+    if Y is not None:
+        h.update(np.ascontiguousarray(Y).tobytes())
+
+    return h.hexdigest()[:16]
@@ -0,0 +1,34 @@
+import os
+import threading
+import contextlib
+import numpy as np
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """Opens a file that replaces path only once it is completely written
+
+    e.g.
+        with atomic_write('weights.npz') as f:
+            np.savez(f, w=w)
+
+    The data goes to a temporary file next to path, which is renamed to
+    path when the with block finishes. Readers therefore see either the
+    old file or the new one, never a partial file, and an interrupted
+    run leaves the old file untouched (the temporary file is removed).
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_array(path, array):
+    """Saves array to path as a .npy file without leaving partial files"""
+    with atomic_write(path) as f:
+        np.save(f, array)
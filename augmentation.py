@@ -0,0 +1,154 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from feature_store import float_rows, raw_rows
+
+# default strength of each augmentation, see augment_batch()
+DEFAULT_PARAMS = {'crop': 0.85,
+                  'flip': True,
+                  'brightness': 0.15,
+                  'contrast': 0.2,
+                  'rotation': 10}
+
+
+def augment_batch(images, rng, crop=0.85, flip=True, brightness=0.15,
+                  contrast=0.2, rotation=10):
+    """Returns a randomly altered copy of a batch of uint8 images
+
+    images has shape (num. images, height, width, channels). Every image
+    gets its own random:
+        - crop:       a window of crop to 1 times the image's size, at a
+                      random position, scaled back up to the full size
+        - flip:       a horizontal flip, half of the time
+        - rotation:   a rotation of up to rotation degrees either way
+        - brightness: a shift of up to brightness * 255 either way
+        - contrast:   a scaling of the pixels' distance from the image's
+                      mean by 1 - contrast to 1 + contrast
+
+    The crop, flip and rotation are combined into one affine transform per
+    image, and all images are resampled at once (bilinear interpolation,
+    edges repeated) with numpy array operations, without a Python loop
+    over the images.
+    """
+    n, h, w, c = images.shape
+    cy, cx = (h - 1) / 2, (w - 1) / 2
+
+    # per-image transform from output pixels to source pixels
+    scale = rng.uniform(crop, 1, n)
+    sign = np.where(flip & (rng.random(n) < 0.5), -1.0, 1.0)
+    theta = np.deg2rad(rng.uniform(-rotation, rotation, n))
+    shift_x = rng.uniform(-1, 1, n) * (1 - scale) * cx
+    shift_y = rng.uniform(-1, 1, n) * (1 - scale) * cy
+
+    cos, sin = np.cos(theta) * scale, np.sin(theta) * scale
+    a, b = cos * sign, -sin
+    d, e = sin * sign, cos
+
+    # the coordinates are computed in float32, which is plenty for pixels
+    a, b, d, e = (p.astype(np.float32) for p in (a, b, d, e))
+    cx_shift = (cx + shift_x).astype(np.float32)
+    cy_shift = (cy + shift_y).astype(np.float32)
+
+    # source coordinates of every output pixel, shape (n, h, w)
+    v, u = np.mgrid[0:h, 0:w].astype(np.float32)
+    u -= cx
+    v -= cy
+    sx = a[:, None, None] * u + b[:, None, None] * v + cx_shift[:, None, None]
+    sy = d[:, None, None] * u + e[:, None, None] * v + cy_shift[:, None, None]
+    np.clip(sx, 0, w - 1, out=sx)
+    np.clip(sy, 0, h - 1, out=sy)
+
+    # bilinear interpolation between the 4 surrounding pixels
+    x0 = np.minimum(sx.astype(np.intp), w - 2)
+    y0 = np.minimum(sy.astype(np.intp), h - 2)
+    fx = (sx - x0)[..., None]
+    fy = (sy - y0)[..., None]
+    i = np.arange(n)[:, None, None]
+
+    out = images[i, y0, x0] * ((1 - fx) * (1 - fy))
+    out += images[i, y0, x0 + 1] * (fx * (1 - fy))
+    out += images[i, y0 + 1, x0] * ((1 - fx) * fy)
+    out += images[i, y0 + 1, x0 + 1] * (fx * fy)
+
+    # contrast around each image's mean, then brightness
+    mean = out.mean(axis=(1, 2, 3), keepdims=True)
+    factor = rng.uniform(1 - contrast, 1 + contrast, (n, 1, 1, 1)).astype(np.float32)
+    offset = rng.uniform(-brightness, brightness, (n, 1, 1, 1)).astype(np.float32) * 255
+    out -= mean
+    out *= factor
+    out += mean + offset
+
+    return np.clip(out, 0, 255, out=out).astype(np.uint8)
+
+
+def _augment_job(images, seed, params):
+    """Augments one batch in a worker process
+
+    Each batch has its own seed, so the result doesn't depend on which
+    worker ran it or in what order.
+    """
+    return augment_batch(images, np.random.default_rng(seed), **params)
+
+
+def augmented_minibatches(X, Y, input_shape, batch_size=256, shuffle=True,
+                          seed=595, workers=None, prefetch=4, **params):
+    """Creates a source of augmented mini-batches for train_streaming
+
+    Works like logistic_regression.minibatches(), but every image in a
+    batch is replaced by a random variant of itself (see augment_batch();
+    params overrides DEFAULT_PARAMS), so each epoch trains on different
+    variants and nothing is ever written to disk.
+
+    X is a FeatureStore or a uint8 array of images of shape input_shape =
+    (height, width, channels). The batches are augmented in a pool of
+    workers processes (one per core unless workers is given; 0 augments in
+    this process), and up to prefetch batches are prepared ahead of the
+    one being trained on, so the trainer doesn't wait for them.
+
+    Returns a function that takes an epoch number and yields the
+    (X_batch, Y_batch) pairs of that epoch, where X_batch holds float32
+    rows of pixels in [0, 1]
+    """
+
+    n = X.shape[0]
+    input_shape = tuple(input_shape)
+    params = {**DEFAULT_PARAMS, **params}
+    Y = np.asarray(Y)
+
+    def submit(pool, epoch, k, idx):
+        images = raw_rows(X, idx).reshape((len(idx),) + input_shape)
+        seed_k = (seed, epoch, k)
+        if pool is None:
+            return _augment_job(images, seed_k, params)
+        return pool.submit(_augment_job, images, seed_k, params)
+
+    def finish(job):
+        result, idx = job
+        images = result if isinstance(result, np.ndarray) else result.result()
+        rows = images.reshape((len(idx), -1))
+        return float_rows(rows, scale=1 / 255), Y[idx]
+
+    def batches(epoch):
+        order = np.arange(n)
+        if shuffle:
+            np.random.default_rng(seed + epoch).shuffle(order)
+
+        pool = ProcessPoolExecutor(max_workers=workers) if workers != 0 else None
+        try:
+            pending = collections.deque()
+            for k, start in enumerate(range(0, n, batch_size)):
+                # sorting the batch keeps reads from a memory-mapped
+                #   dataset close together on disk
+                idx = np.sort(order[start:start + batch_size])
+                pending.append((submit(pool, epoch, k, idx), idx))
+
+                if len(pending) > prefetch:
+                    yield finish(pending.popleft())
+
+            while pending:
+                yield finish(pending.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    return batches
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+import cv2
+import logistic_regression as lr
+import instrumentation
+from load_images import load_dataset, load_images_from_folder, load_image_names_from_folder
+from model import Model
+from shards import build_shards, ShardedDataset
+from atomic_file import atomic_write
+
+
+def make_dataset(folder, people=50, images_per_person=4, target_images=40,
+                 target_name='George_W_Bush', seed=595):
+    """Writes a synthetic dataset with the same layout as lfw_data
+
+    Creates one folder per person, each holding 250x250 '.jpg' images
+    named [name]_[number].jpg. The target person gets target_images
+    images and everybody else gets images_per_person images. The pixels
+    are smooth random noise so the JPEGs take about as long to decode as
+    real photos.
+    """
+
+    rng = np.random.default_rng(seed)
+    names = [f'Person_{i:04d}' for i in range(people)] + [target_name]
+
+    for name in names:
+        count = target_images if name == target_name else images_per_person
+        os.makedirs(os.path.join(folder, name), exist_ok=True)
+
+        for i in range(count):
+            small = rng.integers(0, 256, (25, 25, 3), dtype=np.uint8)
+            img = cv2.resize(small, (250, 250))
+            cv2.imwrite(os.path.join(folder, name, f'{name}_{i + 1:04d}.jpg'), img)
+
+
+def timeit(fn, repeat=5):
+    """Calls fn repeat times and returns statistics of its run time in seconds"""
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t1)
+
+    return {'min': min(times),
+            'median': float(np.median(times)),
+            'mean': float(np.mean(times)),
+            'repeat': repeat}
+
+
+def run(folder, image_size=(100, 100), iterations=100, repeat=5,
+        target_name='George_W_Bush'):
+    """Times the load, train and inference hot paths on the dataset in folder
+
+    Returns a dictionary of results that can be saved as JSON
+    """
+
+    results = {}
+
+    # loading: decoding from scratch, then a warm run from the cache
+    results['load_dataset_cold'] = timeit(
+        lambda: load_dataset(folder, size=image_size, cache_dir=None), repeat=1)
+    load_images_from_folder(folder, size=image_size)
+    results['load_images_from_folder_warm'] = timeit(
+        lambda: load_images_from_folder(folder, size=image_size), repeat)
+    results['load_image_names_from_folder'] = timeit(
+        lambda: load_image_names_from_folder(folder), repeat)
+
+    images, names = load_dataset(folder, size=image_size)
+    X = images.reshape((images.shape[0], -1)) / 255
+    Y = (names == target_name).reshape((-1, 1)) * 1.0
+    dim = X.shape[1]
+
+    # a single gradient computation
+    w = np.zeros((dim, 1))
+    results['propagate'] = timeit(lambda: lr.propagate(w, 0, X, Y), repeat)
+
+    # the parameters and shards go in a directory that is removed afterwards
+    with tempfile.TemporaryDirectory() as params_dir:
+        # training: fixed iteration count, then each solver to convergence
+        w_path = os.path.join(params_dir, 'weights.mat')
+        b_path = os.path.join(params_dir, 'biases.mat')
+
+        t1 = time.perf_counter()
+        lr.train(X, Y, w_path, b_path, num_iterations=iterations, tol=None)
+        elapsed = time.perf_counter() - t1
+        results['train_per_iteration'] = {'iterations': iterations,
+                                          'seconds': elapsed / iterations}
+
+        for solver in ['gd', 'lbfgs', 'newton-cg']:
+            t1 = time.perf_counter()
+            params = lr.train(X, Y, w_path, b_path, solver=solver)
+            results[f'train_{solver}'] = {'iterations': int(params['iterations']),
+                                          'seconds': time.perf_counter() - t1}
+
+        # inference: one image at a time, then the whole dataset in chunks
+        results['classification'] = timeit(
+            lambda: lr.classification(images[0], w_path, b_path), repeat * 20)
+
+        model = Model(w_path, b_path)
+        batch = timeit(lambda: model.predict_proba_batch(images), repeat)
+        batch['images_per_second'] = len(images) / batch['median']
+        results['batch_scoring'] = batch
+
+        # shards: time until the first mini-batch can be trained on, then a
+        #   full pass over the dataset
+        shard_dir = os.path.join(params_dir, 'shards')
+        results['build_shards'] = timeit(
+            lambda: build_shards(folder, shard_dir, size=image_size, shard_size=64), repeat=1)
+
+        def first_batch():
+            batches = ShardedDataset(shard_dir).minibatches(target_name)
+            next(iter(batches(0)))
+        results['shards_first_batch'] = timeit(first_batch, repeat)
+
+        dataset = ShardedDataset(shard_dir)
+        batches = dataset.minibatches(target_name)
+        shard_pass = timeit(lambda: sum(len(X_batch) for X_batch, _ in batches(0)), repeat)
+        shard_pass['images_per_second'] = len(dataset) / shard_pass['median']
+        results['shards_epoch'] = shard_pass
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the face ID hot paths')
+    parser.add_argument('--people', type=int, default=50)
+    parser.add_argument('--images-per-person', type=int, default=4)
+    parser.add_argument('--target-images', type=int, default=40)
+    parser.add_argument('--image-size', type=int, default=100,
+                        help='width and height the images are resized to')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='gradient descent iterations for the per-iteration timing')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--metrics', default=None,
+                        help='record the instrumentation timers and write them to this '
+                             'file (Prometheus text format if it ends in .prom, '
+                             'otherwise JSON lines)')
+    parser.add_argument('--profile', default=None,
+                        help='run under cProfile and tracemalloc and save the stats here')
+    args = parser.parse_args()
+
+    # generate the dataset in a temporary directory, which is also where
+    #   the load_images cache is created
+    output = os.path.abspath(args.output)
+    metrics = args.metrics and os.path.abspath(args.metrics)
+    profile = args.profile and os.path.abspath(args.profile)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            make_dataset('lfw_data', args.people, args.images_per_person, args.target_images)
+
+            image_size = (args.image_size, args.image_size)
+            if metrics:
+                instrumentation.enable()
+
+            if profile:
+                with instrumentation.profile(profile, memory=True):
+                    results = run('lfw_data', image_size, args.iterations, args.repeat)
+            else:
+                results = run('lfw_data', image_size, args.iterations, args.repeat)
+        finally:
+            # leave the directory so it can be removed
+            os.chdir(cwd)
+
+    if metrics:
+        if metrics.endswith('.prom'):
+            instrumentation.write_prometheus(metrics)
+        else:
+            instrumentation.write_json_lines(metrics)
+        print(f'Saved metrics to {metrics}')
+
+    report = {'params': vars(args),
+              'python': sys.version.split()[0],
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    with atomic_write(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f'Saved results to {output}')
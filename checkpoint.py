@@ -0,0 +1,80 @@
+import os
+import glob
+import numpy as np
+from atomic_file import atomic_write
+
+
+def checkpoint_prefix(w_path):
+    """Returns the prefix of the checkpoint files of the weights at w_path
+
+    e.g. 'gd_results/training_weights3.mat' -->
+         'gd_results/training_weights3_checkpoint'
+    """
+    return f'{os.path.splitext(w_path)[0]}_checkpoint'
+
+
+def save_checkpoint(prefix, iteration, state, keep=2):
+    """Saves a snapshot of a training run to '<prefix>_<iteration>.npz'
+
+    state is a dictionary of numpy arrays and numbers (e.g. w, b, the
+    optimizer state and the loss curve). The file is written to a
+    temporary path first and then renamed, so an interrupted run never
+    leaves a half-written checkpoint behind. Only the newest keep
+    checkpoints are kept.
+
+    Returns the path of the checkpoint
+    """
+    path = f'{prefix}_{iteration:08d}.npz'
+    with atomic_write(path) as f:
+        np.savez(f, iteration=iteration, **state)
+
+    for old in list_checkpoints(prefix)[:-keep]:
+        os.remove(old)
+
+    return path
+
+
+def list_checkpoints(prefix):
+    """Returns the paths of the checkpoints with prefix, oldest first"""
+    return sorted(glob.glob(f'{glob.escape(prefix)}_[0-9]*.npz'))
+
+
+def load_checkpoint(prefix):
+    """Loads the newest checkpoint saved by save_checkpoint()
+
+    Returns a dictionary of the saved arrays, or None if there is no
+    checkpoint to resume from
+    """
+    paths = list_checkpoints(prefix)
+    if not paths:
+        return None
+
+    with np.load(paths[-1]) as data:
+        state = {key: data[key] for key in data.files}
+
+    print(f'Resuming from {paths[-1]}')
+    return state
+
+
+def check_checkpoint(state, **expected):
+    """Makes sure a loaded checkpoint was saved by the same kind of run
+
+    e.g. check_checkpoint(state, kind='streaming', optimizer='adam')
+
+    Every keyword names a field the run saved with its snapshots and the
+    value it must have. train() and train_streaming() share the checkpoint
+    prefix of the weights, so without this one could resume the other's
+    snapshot (or momentum could pick up Adam's moment estimates).
+    Raises a ValueError naming the first field that differs
+    """
+    for key, value in expected.items():
+        found = str(state[key]) if key in state else None
+        if found != value:
+            raise ValueError(f'The checkpoint was saved with {key}={found}, not {value}; '
+                             'resume the run that saved it or start over without resume')
+
+
+def clear_checkpoints(prefix):
+    """Deletes every checkpoint with prefix, e.g. before a fresh run"""
+    for path in list_checkpoints(prefix):
+        os.remove(path)
@@ -1,18 +1,14 @@
-import numpy as np
-import scipy
+from model import Model
 
 #imported from training.ipynb file
-w = scipy.io.loadmat('training_weights.mat')['weights'] 
-b = scipy.io.loadmat('training_biases.mat')['biases'] 
+# the parameters are loaded once, the first time classification() is called
+model = None
 
 def classification(image):
-    #reshape photo data
-    X = image.reshape((image.shape[0], np.prod(image.shape[1:4])))
-    X = X / 255
-
-    # calculate probabilities for testing data 
-    A = 1 / (1 + np.exp(-(np.dot(X, w) + b)))
+    global model
+    if model is None:
+        model = Model('training_weights.mat', 'training_biases.mat')
 
     # assign labels to the samples using their probabilities
-    Y = (A >= 0.5) * 1.0
+    Y = model.predict(image)
     return Y
@@ -0,0 +1,200 @@
+import os
+import threading
+import numpy as np
+import cv2
+from instrumentation import timer, count
+
+# the frontal face cascade that ships with OpenCV
+CASCADE = 'haarcascade_frontalface_default.xml'
+
+# fraction of the face's size added around it on every side, so the
+#   crops include the whole head like the LFW images do
+MARGIN = 0.25
+
+
+# cascades loaded by each thread, see load_cascade()
+_local = threading.local()
+
+
+def load_cascade(name=CASCADE):
+    """Loads a Haar cascade once per thread
+
+    name is a file path or the name of one of the cascades in OpenCV's
+    data directory (cv2.data.haarcascades). Every thread gets its own
+    copy, since load_dataset() detects faces on several threads at once.
+    Raises a ValueError if this OpenCV build has no Haar cascades.
+    """
+    cascades = getattr(_local, 'cascades', None)
+    if cascades is None:
+        cascades = _local.cascades = {}
+    if name not in cascades:
+        cascades[name] = _load_cascade(name)
+    return cascades[name]
+
+
+def _load_cascade(name):
+    # OpenCV 5 moved the Haar cascades out of the main package
+    if not hasattr(cv2, 'CascadeClassifier'):
+        raise ValueError(f'OpenCV {cv2.__version__} has no cv2.CascadeClassifier; face '
+                         'detection needs OpenCV 4 (opencv-python<5) or a build '
+                         'with the contrib modules (opencv-contrib-python)')
+
+    path = name
+    if not os.path.exists(path) and hasattr(cv2, 'data'):
+        path = os.path.join(cv2.data.haarcascades, name)
+
+    cascade = cv2.CascadeClassifier(path)
+    if cascade.empty():
+        raise ValueError(f'Could not load the Haar cascade {name}')
+    return cascade
+
+
+def detect_faces(image, cascade=None, scale=0.5, min_size=(40, 40)):
+    """Finds the faces in an image with a Haar cascade
+
+    The image is converted to grayscale and shrunk by scale before the
+    search, which makes detection several times faster; min_size is the
+    smallest face to look for in the original image.
+
+    Returns a (num. faces, 4) array of the faces' x, y, width and height
+    in the original image, largest face first
+    """
+    cascade = cascade or load_cascade()
+
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if scale != 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = cv2.equalizeHist(gray)
+
+    with timer('detect.cascade'):
+        faces = cascade.detectMultiScale(gray,
+                                         scaleFactor=1.1,
+                                         minNeighbors=5,
+                                         minSize=(max(1, int(min_size[0] * scale)),
+                                                  max(1, int(min_size[1] * scale))))
+
+    if len(faces) == 0:
+        return np.empty((0, 4), dtype=int)
+
+    faces = np.round(np.asarray(faces) / scale).astype(int)
+    return faces[np.argsort(-faces[:, 2] * faces[:, 3])]
+
+
+def align_box(face, image_shape, margin=MARGIN):
+    """Turns a detected face into the square box that is cropped
+
+    The box is centered on the face and margin times the face's size
+    larger on every side, so faces are framed the same way no matter how
+    large they are in the image. It is moved (and if necessary shrunk)
+    to stay inside the image.
+
+    Returns the box's x, y, width and height
+    """
+    x, y, w, h = face
+    side = int(round(max(w, h) * (1 + 2 * margin)))
+    side = min(side, image_shape[0], image_shape[1])
+
+    cx, cy = x + w / 2, y + h / 2
+    x = int(round(min(max(cx - side / 2, 0), image_shape[1] - side)))
+    y = int(round(min(max(cy - side / 2, 0), image_shape[0] - side)))
+    return x, y, side, side
+
+
+def crop_face(image, box, size):
+    """Crops a box out of an image and resizes it to size = (width, height)"""
+    x, y, w, h = box
+    return cv2.resize(image[y:y + h, x:x + w], tuple(size), interpolation=cv2.INTER_AREA)
+
+
+def center_box(image_shape, fraction=0.5):
+    """Returns the centered square box used when no face is detected
+
+    The faces in the LFW images take up about the center half of the
+    image, so this frames them about like align_box() would.
+    """
+    side = int(min(image_shape[0], image_shape[1]) * fraction * (1 + 2 * MARGIN))
+    side = min(side, image_shape[0], image_shape[1])
+    return ((image_shape[1] - side) // 2, (image_shape[0] - side) // 2, side, side)
+
+
+def extract_face(image, size, cascade=None, scale=0.5):
+    """Detects the largest face in an image and returns its aligned crop
+
+    Used on the training images (see load_images.load_dataset()), so they
+    are framed the same way as the faces found in the camera feed. If no
+    face is found, the center of the image is cropped instead.
+    """
+    faces = detect_faces(image, cascade, scale)
+    if len(faces):
+        box = align_box(faces[0], image.shape)
+    else:
+        count('detect.fallbacks')
+        box = center_box(image.shape)
+    return crop_face(image, box, size)
+
+
+class FaceTracker:
+    """Follows a face across the frames of a video
+
+    Searching the whole frame on every frame is wasteful, since the face
+    barely moves between frames. The tracker does a full (downscaled)
+    search only every redetect_every frames or after losing the face; in
+    between it only searches a window search_margin times the face's size
+    around where the face was last seen. The box is smoothed over frames
+    so the crops don't jitter.
+
+    update() returns the aligned box of the face in the frame (see
+    align_box()), or None if there is no face, in which case the frame
+    doesn't need to be classified at all.
+    """
+
+    def __init__(self, cascade=None, scale=0.5, redetect_every=10,
+                 search_margin=0.5, smoothing=0.5, margin=MARGIN):
+        self.cascade = cascade or load_cascade()
+        self.scale = scale
+        self.redetect_every = redetect_every
+        self.search_margin = search_margin
+        self.smoothing = smoothing
+        self.margin = margin
+
+        self.face = None      # last (x, y, w, h) of the face, as floats
+        self.frames = 0       # frames since the last full search
+
+    def _search_window(self, frame_shape):
+        x, y, w, h = self.face
+        dx, dy = w * self.search_margin, h * self.search_margin
+        x0, y0 = int(max(x - dx, 0)), int(max(y - dy, 0))
+        x1 = int(min(x + w + dx, frame_shape[1]))
+        y1 = int(min(y + h + dy, frame_shape[0]))
+        return x0, y0, x1, y1
+
+    def update(self, frame):
+        """Finds the face in the next frame"""
+        full_search = self.face is None or self.frames >= self.redetect_every
+
+        if full_search:
+            count('detect.full_searches')
+            faces = detect_faces(frame, self.cascade, self.scale)
+            self.frames = 0
+        else:
+            x0, y0, x1, y1 = self._search_window(frame.shape)
+
+            # the window is small, so it can be searched at full resolution
+            faces = detect_faces(frame[y0:y1, x0:x1], self.cascade, scale=1)
+            faces = faces + np.array([x0, y0, 0, 0])
+            self.frames += 1
+
+        if len(faces) == 0:
+            self.face = None
+            return None
+
+        face = faces[0].astype(np.float64)
+        if self.face is not None and not full_search:
+            face = self.smoothing * np.asarray(self.face) + (1 - self.smoothing) * face
+        self.face = face
+
+        return align_box(np.round(face).astype(int), frame.shape, self.margin)
+
+    def reset(self):
+        self.face = None
+        self.frames = 0
@@ -0,0 +1,295 @@
+import numpy as np
+from feature_store import float_rows
+from atomic_file import atomic_write
+
+# number of rows embedded at a time when enrolling a whole dataset
+CHUNK_SIZE = 1024
+
+
+def randomized_pca(X, n_components=100, oversample=10, n_iter=2, seed=595):
+    """Finds the mean and top principal components (eigenfaces) of X
+
+    X is a (num. samples, num. features) array of values in [0, 1] or a
+    FeatureStore. Uses a randomized SVD: X is multiplied by a small random
+    matrix to find the subspace holding most of its variance, refined with
+    n_iter power iterations, and only that (n_components + oversample)
+    dimensional subspace is decomposed exactly. X is only ever touched
+    through X.dot() and X.T.dot(), so a FeatureStore is never converted
+    to floating point all at once.
+
+    Returns the mean image (num. features,) and the components
+    (n_components, num. features) as float32 arrays
+    """
+
+    n, d = X.shape
+    k = min(n_components + oversample, n, d)
+    rng = np.random.default_rng(seed)
+
+    ones = np.ones((n, 1), dtype=np.float32)
+    mean = np.ravel(X.T.dot(ones)) / n
+
+    # products with the centered matrix X - mean, without forming it
+    def centered_dot(M):
+        return X.dot(M) - mean.dot(M)
+
+    def centered_T_dot(M):
+        return X.T.dot(M) - np.outer(mean, np.sum(M, axis=0))
+
+    # random range finder with power iterations
+    Q, _ = np.linalg.qr(centered_dot(rng.standard_normal((d, k)).astype(np.float32)))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(centered_T_dot(Q))
+        Q, _ = np.linalg.qr(centered_dot(Q))
+
+    # exact SVD of the small (k, d) projection of X onto the subspace
+    B = centered_T_dot(Q).T
+    _, _, Vt = np.linalg.svd(B, full_matrices=False)
+
+    return mean.astype(np.float32), Vt[:n_components].astype(np.float32)
+
+
+def _top_k(similarity, k):
+    """Returns the indices of the k largest values in each row, largest first
+
+    np.argpartition finds the k largest values without sorting the whole
+    row, and only those k are sorted.
+    """
+    n = similarity.shape[-1]
+    if k >= n:
+        return np.argsort(-similarity, axis=-1)
+    if k == 0:
+        return np.empty(similarity.shape[:-1] + (0,), dtype=np.intp)
+
+    top = np.argpartition(-similarity, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(similarity, top, axis=-1), axis=-1)
+    return np.take_along_axis(top, order, axis=-1)
+
+
+class FaceIndex:
+    """A searchable collection of enrolled face embeddings
+
+    Every face is projected onto the eigenfaces found by randomized_pca()
+    and normalized to unit length, so the cosine similarity of two faces
+    is the dot product of their embeddings. Enrolling a new person only
+    requires embedding their images; nothing has to be retrained.
+
+    search() compares the query faces with every enrolled embedding using
+    one matrix product (brute force). After build_ivf(), it can instead
+    search approximately by only comparing against the embeddings in the
+    n_probe clusters closest to each query. The clusters are stored as
+    inverted lists (the embeddings' ids sorted by cluster, plus the offset
+    where each cluster starts), so a query only touches its candidates.
+    """
+
+    def __init__(self, mean, components):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.vectors = np.empty((0, self.components.shape[0]), dtype=np.float32)
+        self.names = np.array([], dtype=str)
+
+        # clusters of the approximate (IVF) search, see build_ivf()
+        self.centroids = None
+        self.lists = None
+
+        # inverted lists built from self.lists, see _inverted_lists()
+        self._ids = None
+        self._offsets = None
+        self._grouped = None
+
+    @classmethod
+    def fit(cls, X, n_components=100, seed=595):
+        """Creates an empty index whose eigenfaces are fit to the dataset X"""
+        mean, components = randomized_pca(X, n_components, seed=seed)
+        return cls(mean, components)
+
+    def embed(self, images):
+        """Returns the unit-length embeddings of images
+
+        images is a single image, a stack of images, or a FeatureStore
+        (which is embedded chunk by chunk)
+        """
+        if hasattr(images, 'chunks'):
+            out = np.empty((images.shape[0], self.components.shape[0]), dtype=np.float32)
+            for start, stop, chunk in images.chunks(CHUNK_SIZE):
+                out[start:stop] = self._embed_rows(chunk)
+            return out
+
+        return self._embed_rows(float_rows(images, self.mean.size, scale=1 / 255))
+
+    def _embed_rows(self, X):
+        V = np.dot(X - self.mean, self.components.T)
+        V /= np.maximum(np.linalg.norm(V, axis=1, keepdims=True), 1e-12)
+        return V
+
+    def enroll(self, names, images):
+        """Adds the faces in images to the index under the given name(s)
+
+        names is either one name for all of the images, or a list with
+        the name of each image
+        """
+        vectors = self.embed(images)
+        if isinstance(names, str):
+            names = [names] * len(vectors)
+
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.names = np.concatenate([self.names, np.asarray(names, dtype=str)])
+
+        # new faces join the cluster closest to them
+        if self.centroids is not None:
+            self.lists = np.concatenate([self.lists, self._nearest_lists(vectors, 1)[:, 0]])
+            self._ids = None
+
+    def _nearest_lists(self, vectors, n_probe):
+        similarity = np.dot(vectors, self.centroids.T)
+        return _top_k(similarity, min(n_probe, len(self.centroids)))
+
+    def _inverted_lists(self):
+        """Returns the inverted lists of the clusters
+
+        ids holds the ids of the embeddings sorted by cluster and grouped
+        holds the embeddings in the same order, so the ids and embeddings
+        of cluster c are ids[offsets[c]:offsets[c + 1]] and a contiguous
+        slice of grouped. They are rebuilt after the clusters change.
+
+        Returns ids, offsets and grouped
+        """
+        if self._ids is None:
+            self._ids = np.argsort(self.lists, kind='stable')
+            counts = np.bincount(self.lists, minlength=len(self.centroids))
+            self._offsets = np.concatenate([[0], np.cumsum(counts)])
+            self._grouped = self.vectors[self._ids]
+        return self._ids, self._offsets, self._grouped
+
+    def build_ivf(self, n_lists=None, n_iter=10, seed=595):
+        """Clusters the enrolled embeddings for approximate search
+
+        Runs k-means (on the unit sphere) with n_lists clusters, by default
+        about the square root of the number of enrolled faces.
+        """
+        n = len(self.vectors)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+
+        centroids = self.vectors[rng.choice(n, size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            lists = np.argmax(np.dot(self.vectors, centroids.T), axis=1)
+            for c in range(n_lists):
+                members = self.vectors[lists == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        self.centroids = centroids
+        self.lists = np.argmax(np.dot(self.vectors, centroids.T), axis=1)
+        self._ids = None
+
+    def search(self, images, k=1, n_probe=None):
+        """Finds the k enrolled faces most similar to each query image
+
+        If n_probe is given (and build_ivf() was called), only the faces in
+        the n_probe closest clusters are compared, which is faster but may
+        miss the best match.
+
+        Returns a dictionary with the names and cosine similarities of the
+        matches, both of shape (num. images, k), best match first
+        """
+        queries = self.embed(images)
+        k = min(k, len(self.vectors))
+
+        if n_probe is None or self.centroids is None:
+            similarity = np.dot(queries, self.vectors.T)
+            top = _top_k(similarity, k)
+            return {'names': self.names[top],
+                    'scores': np.take_along_axis(similarity, top, axis=1)}
+
+        probes = self._nearest_lists(queries, n_probe)
+        ids, offsets, grouped = self._inverted_lists()
+
+        # the best k matches of every query in each of its probed clusters
+        n_queries, n_probe = probes.shape
+        candidates = np.full((n_queries, n_probe, k), -1, dtype=np.intp)
+        scores = np.full((n_queries, n_probe, k), -np.inf, dtype=np.float32)
+
+        # go through the clusters instead of the queries, so all the queries
+        #   that probe a cluster are compared with it in one matrix product
+        pairs = np.argsort(probes, axis=None, kind='stable')
+        clusters = probes.ravel()[pairs]
+        bounds = np.flatnonzero(np.diff(clusters)) + 1
+
+        for group in np.split(pairs, bounds):
+            c = probes.flat[group[0]]
+            start, stop = offsets[c], offsets[c + 1]
+            if start == stop:
+                continue
+
+            q, slot = np.unravel_index(group, probes.shape)
+            similarity = np.dot(queries[q], grouped[start:stop].T)
+            top = _top_k(similarity, min(k, stop - start))
+            candidates[q, slot, :top.shape[1]] = ids[start + top]
+            scores[q, slot, :top.shape[1]] = np.take_along_axis(similarity, top, axis=1)
+
+        # merge the matches from the probed clusters
+        candidates = candidates.reshape((n_queries, -1))
+        scores = scores.reshape((n_queries, -1))
+        best = _top_k(scores, k)
+        candidates = np.take_along_axis(candidates, best, axis=1)
+        scores = np.take_along_axis(scores, best, axis=1)
+
+        # queries whose clusters hold fewer than k faces get empty names
+        names = np.where(candidates >= 0, self.names[np.maximum(candidates, 0)], '')
+        names = names.astype(self.names.dtype)
+
+        return {'names': names, 'scores': scores}
+
+    def identify(self, image, threshold=0.8, n_probe=None):
+        """Returns the name of the enrolled person in image, or None
+
+        The closest enrolled face has to have a cosine similarity of at
+        least threshold for the person to be identified. Nobody is
+        identified while the index is empty.
+        """
+        if len(self.vectors) == 0:
+            return None
+
+        match = self.search(image, k=1, n_probe=n_probe)
+        if match['scores'][0, 0] < threshold:
+            return None
+        return str(match['names'][0, 0])
+
+    def save(self, path):
+        """Saves the eigenfaces, embeddings and clusters to a .npz file"""
+        arrays = {'mean': self.mean,
+                  'components': self.components,
+                  'vectors': self.vectors,
+                  'names': self.names}
+        if self.centroids is not None:
+            arrays['centroids'] = self.centroids
+            arrays['lists'] = self.lists
+
+        with atomic_write(path) as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index written by save()"""
+        with np.load(path) as data:
+            index = cls(data['mean'], data['components'])
+            index.vectors = data['vectors']
+            index.names = data['names']
+            if 'centroids' in data:
+                index.centroids = data['centroids']
+                index.lists = data['lists']
+
+        return index
+
+
+if __name__ == '__main__':
+    # fit the eigenfaces to the dataset and enroll everybody in it
+    from feature_store import FeatureStore
+    from load_images import load_image_names_from_folder
+
+    X = FeatureStore.from_folder('lfw_data', size=(100, 100))
+    index = FaceIndex.fit(X)
+    index.enroll(load_image_names_from_folder('lfw_data'), X)
+    index.build_ivf()
+    index.save('face_index.npz')
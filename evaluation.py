@@ -0,0 +1,288 @@
+import json
+import numpy as np
+import scipy.optimize
+import scipy.special
+from model import Model
+from splits import stratified_split
+from atomic_file import atomic_write
+
+# clip probabilities this far away from 0 and 1 before taking logits
+EPSILON = 1e-7
+
+# number of bins of the expected calibration error
+CALIBRATION_BINS = 10
+
+
+def operating_points(scores, labels):
+    """Counts the outcomes of every possible decision threshold
+
+    The scores are sorted once (highest first), and the cumulative number
+    of positive labels along that order gives the true positives (tp) and
+    false positives (fp) of every threshold at once: a threshold equal to
+    the i-th distinct score accepts every sample scoring at least that much.
+
+    Returns a dictionary with the thresholds (highest first), tp and fp at
+    each of them, and the total number of positives and negatives
+    """
+    scores = np.ravel(scores).astype(np.float64)
+    labels = np.ravel(labels) == 1
+
+    order = np.argsort(-scores, kind='stable')
+    s = scores[order]
+    y = labels[order]
+
+    # the last position of each distinct score
+    ends = np.append(np.flatnonzero(np.diff(s)), len(s) - 1)
+
+    tp = np.cumsum(y)[ends]
+    fp = ends + 1 - tp
+
+    return {'thresholds': s[ends],
+            'tp': tp,
+            'fp': fp,
+            'positives': int(np.sum(labels)),
+            'negatives': int(len(labels) - np.sum(labels))}
+
+
+def curves(points):
+    """Computes the ROC and precision-recall curves from operating_points()
+
+    FAR (false acceptance rate) is the fraction of other people that are
+    accepted, i.e. the false positive rate, and FRR (false rejection
+    rate) is the fraction of the target person's images that are rejected.
+    """
+    P = max(points['positives'], 1)
+    N = max(points['negatives'], 1)
+    tp, fp = points['tp'], points['fp']
+
+    recall = tp / P
+    return {'thresholds': points['thresholds'],
+            'far': fp / N,
+            'frr': 1 - recall,
+            'recall': recall,
+            'precision': tp / np.maximum(tp + fp, 1)}
+
+
+def auc(far, recall):
+    """Returns the area under the ROC curve (trapezoidal rule)"""
+    x = np.concatenate([[0], far])
+    y = np.concatenate([[0], recall])
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2))
+
+
+def average_precision(recall, precision):
+    """Returns the area under the precision-recall curve (step rule)"""
+    return float(np.sum(np.diff(np.concatenate([[0], recall])) * precision))
+
+
+def confusion_matrix(scores, labels, threshold):
+    """Returns the true/false positives/negatives at threshold"""
+    accepted = np.ravel(scores) >= threshold
+    labels = np.ravel(labels) == 1
+    return {'tp': int(np.sum(accepted & labels)),
+            'fp': int(np.sum(accepted & ~labels)),
+            'tn': int(np.sum(~accepted & ~labels)),
+            'fn': int(np.sum(~accepted & labels))}
+
+
+def recommend_threshold(c, max_far=0.01, min_threshold=0.5):
+    """Picks the unlock threshold from the curves
+
+    Returns the threshold that rejects the fewest of the target person's
+    images while accepting at most max_far of everybody else. If no
+    threshold is that strict, the equal error rate threshold is used.
+    The threshold is never below min_threshold, since a face is only
+    recognized if its label is 1 as well (see face_id.py).
+    """
+    allowed = np.flatnonzero(c['far'] <= max_far)
+    if len(allowed):
+        # FAR only grows as the threshold decreases, so the last allowed
+        #   threshold has the lowest FRR
+        threshold = c['thresholds'][allowed[-1]]
+    else:
+        threshold = c['thresholds'][np.argmin(np.abs(c['far'] - c['frr']))]
+
+    return float(max(threshold, min_threshold))
+
+
+def platt_fit(scores, labels):
+    """Fits Platt scaling, p' = sigmoid(a * logit(p) + b), to the scores
+
+    Uses the smoothed targets from Platt's paper so that a perfectly
+    separated training set doesn't push a and b to infinity.
+
+    Returns a and b
+    """
+    z = scipy.special.logit(np.clip(np.ravel(scores), EPSILON, 1 - EPSILON))
+    labels = np.ravel(labels) == 1
+    P, N = np.sum(labels), np.sum(~labels)
+    t = np.where(labels, (P + 1) / (P + 2), 1 / (N + 2))
+
+    def loss(params):
+        a, b = params
+        u = a * z + b
+        p = scipy.special.expit(u)
+        value = np.sum(np.logaddexp(0, u) - t * u)
+        return value, np.array([np.dot(p - t, z), np.sum(p - t)])
+
+    result = scipy.optimize.minimize(loss, [1.0, 0.0], jac=True, method='L-BFGS-B')
+    return float(result.x[0]), float(result.x[1])
+
+
+def platt_calibrate(scores, a, b):
+    """Applies the Platt scaling fit by platt_fit()"""
+    z = scipy.special.logit(np.clip(scores, EPSILON, 1 - EPSILON))
+    return scipy.special.expit(a * z + b)
+
+
+def isotonic_fit(scores, labels):
+    """Fits a non-decreasing step function from scores to probabilities
+
+    Uses the pool adjacent violators algorithm on the distinct scores in
+    ascending order: neighbouring blocks whose mean labels are out of order are
+    merged until the means only increase.
+
+    Returns the lowest score of each step and the probability of the step
+    """
+    # samples with the same score always get the same probability,
+    #   so start with one block per distinct score (sorted ascending)
+    steps, inverse = np.unique(np.ravel(scores), return_inverse=True)
+    label_sums = np.bincount(inverse, weights=(np.ravel(labels) == 1) * 1.0)
+    label_counts = np.bincount(inverse)
+
+    # each block is (sum of labels, num. samples, first step)
+    sums, counts, starts = [], [], []
+    for i in range(len(steps)):
+        sums.append(label_sums[i])
+        counts.append(label_counts[i])
+        starts.append(i)
+        while len(sums) > 1 and sums[-2] * counts[-1] >= sums[-1] * counts[-2]:
+            total, count = sums.pop(), counts.pop()
+            sums[-1] += total
+            counts[-1] += count
+            starts.pop()
+
+    return steps[starts], np.asarray(sums) / np.asarray(counts)
+
+
+def isotonic_calibrate(scores, steps, values):
+    """Applies the step function fit by isotonic_fit()"""
+    i = np.searchsorted(steps, scores, side='right') - 1
+    return values[np.clip(i, 0, len(values) - 1)]
+
+
+def calibration_error(probs, labels, bins=CALIBRATION_BINS):
+    """Returns the expected calibration error of probabilities
+
+    The probabilities are split into equal-width bins, and the gaps between
+    each bin's mean probability and its fraction of positive labels are
+    averaged, weighted by the number of samples in the bin.
+    """
+    probs = np.ravel(probs)
+    labels = (np.ravel(labels) == 1).astype(np.float64)
+    which = np.minimum((probs * bins).astype(int), bins - 1)
+
+    sum_probs = np.bincount(which, weights=probs, minlength=bins)
+    sum_labels = np.bincount(which, weights=labels, minlength=bins)
+    return float(np.sum(np.abs(sum_probs - sum_labels)) / max(len(probs), 1))
+
+
+def evaluate(scores, labels, max_far=0.01, seed=595):
+    """Builds a full evaluation report of the predicted probabilities
+
+    The report holds the ROC AUC, the average precision, the equal error
+    rate, the recommended unlock threshold (see recommend_threshold()) and
+    the confusion matrix, FAR and FRR at that threshold, how well the
+    probabilities are calibrated, and the FAR, FRR, precision and recall
+    curves at every threshold.
+
+    The scores should come from samples the model wasn't trained on (see
+    splits.holdout_split()), since the threshold is picked on them. The
+    Platt and isotonic maps are fit on a stratified half of the samples
+    (picked with seed) and every calibration number (Brier score and
+    expected calibration error, raw and calibrated) is measured on the
+    other half, so the calibrated numbers aren't flattered by fitting
+    and scoring on the same data.
+    """
+    scores = np.ravel(scores).astype(np.float64)
+    labels = (np.ravel(labels) == 1).astype(np.float64)
+
+    c = curves(operating_points(scores, labels))
+    eer_index = int(np.argmin(np.abs(c['far'] - c['frr'])))
+
+    threshold = recommend_threshold(c, max_far)
+    confusion = confusion_matrix(scores, labels, threshold)
+    P = max(confusion['tp'] + confusion['fn'], 1)
+    N = max(confusion['fp'] + confusion['tn'], 1)
+
+    fit, held_out = stratified_split(labels, test_size=0.5, seed=seed)
+    a, b = platt_fit(scores[fit], labels[fit])
+    steps, values = isotonic_fit(scores[fit], labels[fit])
+
+    raw, truth = scores[held_out], labels[held_out]
+    platt = platt_calibrate(raw, a, b)
+    isotonic = isotonic_calibrate(raw, steps, values)
+
+    return {'samples': len(scores),
+            'positives': int(np.sum(labels)),
+            'negatives': int(len(labels) - np.sum(labels)),
+            'auc': auc(c['far'], c['recall']),
+            'average_precision': average_precision(c['recall'], c['precision']),
+            'eer': float((c['far'][eer_index] + c['frr'][eer_index]) / 2),
+            'eer_threshold': float(c['thresholds'][eer_index]),
+            'max_far': max_far,
+            'threshold': threshold,
+            'far': confusion['fp'] / N,
+            'frr': confusion['fn'] / P,
+            'accuracy': (confusion['tp'] + confusion['tn']) / max(len(scores), 1),
+            'confusion': confusion,
+            'calibration': {'platt': {'a': a, 'b': b},
+                            'samples': len(held_out),
+                            'brier': float(np.mean((raw - truth) ** 2)),
+                            'brier_platt': float(np.mean((platt - truth) ** 2)),
+                            'brier_isotonic': float(np.mean((isotonic - truth) ** 2)),
+                            'ece': calibration_error(raw, truth),
+                            'ece_platt': calibration_error(platt, truth),
+                            'ece_isotonic': calibration_error(isotonic, truth)},
+            'curves': {key: value.tolist() for key, value in c.items()}}
+
+
+def summary(report):
+    """Returns the report without its curves, small enough for model metadata"""
+    return {key: value for key, value in report.items() if key != 'curves'}
+
+
+def print_report(report):
+    """Prints the main numbers of an evaluation report"""
+    confusion = report['confusion']
+    print(f"Samples: {report['samples']} "
+          f"({report['positives']} positive, {report['negatives']} negative)")
+    print(f"ROC AUC: {report['auc']:.4f}   Average precision: {report['average_precision']:.4f}")
+    print(f"Equal error rate: {report['eer']:.4f} at threshold {report['eer_threshold']:.3f}")
+    print(f"Recommended threshold: {report['threshold']:.3f} "
+          f"(FAR {report['far']:.4f}, FRR {report['frr']:.4f}, "
+          f"accuracy {report['accuracy']:.4f})")
+    print(f"Confusion matrix: TP {confusion['tp']}  FP {confusion['fp']}  "
+          f"TN {confusion['tn']}  FN {confusion['fn']}")
+    calibration = report['calibration']
+    print(f"Brier score: {calibration['brier']:.4f} raw, "
+          f"{calibration['brier_platt']:.4f} Platt, "
+          f"{calibration['brier_isotonic']:.4f} isotonic")
+
+
+def save_report(report, path):
+    """Writes the report, including its curves, to a JSON file"""
+    with atomic_write(path, 'w') as f:
+        json.dump(report, f)
+
+
+def save_to_artifact(report, artifact_path):
+    """Stores the report summary and its threshold in a model artifact
+
+    The artifact is rewritten with the recommended threshold as the
+    model's decision threshold, so face_id.py unlocks at that threshold.
+    """
+    model = Model(artifact_path=artifact_path)
+    model.save_artifact(artifact_path,
+                        threshold=report['threshold'],
+                        evaluation=summary(report))
@@ -1,33 +1,64 @@
 import logistic_regression as lr 
-from pic_ops import capture_image, crop_image, resize_image
-from clean_up import clean_up
-from load_images import load_images_from_folder, load_image_names_from_folder
+from pic_ops import capture_image, crop_array, resize_array, recognize_stream
+from detection import extract_face
+from model import Model
+from artifact import data_hash
+from load_images import load_image_names_from_folder
+from feature_store import FeatureStore
+from splits import binary_labels, holdout_split
 import os 
-import numpy as np
 from sklearn.model_selection import train_test_split
-import cv2 
 import credentials as creds
-import random
 
 
-# if the files containing the tuned weight and bias parameters
-# both exist, that means the model has already been trained
+# the trained model is stored in a single artifact file that also
+#   records the image size, identity and threshold it was made for
+# gradient descent writes its weight and bias terms to the .mat files
+model_path = 'gd_results/model3.faceid'
 w_path = 'gd_results/training_weights3.mat'
 b_path = 'gd_results/training_biases3.mat'
 
-trained = True
-
-for path in [w_path, b_path]:
-    if not os.path.exists(path):
-        trained = False 
-        break 
-
 image_path = 'lfw_data'
 image_size = (100, 100)
+input_shape = (image_size[1], image_size[0], 3)
 
 target_name = 'George_W_Bush'
 
-# if either file does not exist, the model needs to be trained
+# optional preprocessing stage applied before the classifier, e.g.
+#   Preprocessor(input_shape, grayscale=True, downsample=2,
+#                projection='pca', n_components=256)
+# it is saved in the model artifact and applied by the model
+preprocessor = None
+
+# when detect is True, faces are found with a Haar cascade both in the
+#   training images and in the camera feed, instead of using the whole
+#   training image and a fixed box in the feed; the model has to be
+#   retrained after changing this
+detect = False
+
+# hyperparameters used by gradient descent
+hyperparameters = {'solver': 'gd', 'num_iterations': 15000, 'learning_rate': 0.0005}
+
+# if only the older weight and bias files exist, convert them
+#   to the artifact format
+if not os.path.exists(model_path) and os.path.exists(w_path) and os.path.exists(b_path):
+    Model(w_path, b_path).save_artifact(model_path,
+                                        input_shape=input_shape,
+                                        identities=[target_name],
+                                        threshold=0.7,
+                                        hyperparameters=hyperparameters)
+
+# the model has already been trained if its artifact exists and was
+#   made for images of this size
+trained = True
+
+try:
+    model = Model(artifact_path=model_path, input_shape=input_shape)
+except (OSError, ValueError) as e:
+    print(e)
+    trained = False
+
+# if there is no usable model, it needs to be trained
 if not trained:
     '''
     For this specific case, we are training the model to 
@@ -36,17 +67,11 @@ if not trained:
 
     print('Did not find existing weight and bias values.')
 
-    # load the image set and store it in a list
-    # the images will need to be resized to make
+    # load the image set as a memory-mapped matrix of flattened
+    #   uint8 pixels; the images will need to be resized to make
     #   computation times reasonable
-    images = load_images_from_folder(image_path, size=image_size)
-
-    # convert the list of images into a numpy array
-    X = np.stack(images, axis=0)
-
-    # flatten and normalize the data
-    X = X.reshape((X.shape[0], np.prod(X.shape[1:4])))
-    X = X / 255 
+    # the pixels are normalized to [0, 1] chunk by chunk during training
+    X = FeatureStore.from_folder(image_path, size=image_size, detect=detect)
 
     print(f'Shape of data: {X.shape}')
 
@@ -56,103 +81,117 @@ if not trained:
     # convert the names into labels:
     # target name   --> 1
     # otherwise     --> 0
-    Y = np.array([1 if name == target_name else 0 for name in names])
-    Y = Y.reshape((Y.shape[0], 1))
+    Y = binary_labels(names, target_name)
     #print(f'Shape of labels: {Y.shape}')
-    # # extract the indices corresponding to the target name
-    target_indices = [i for i in range(len(names)) if target_name in names[i]]
-    others_indices = [i for i in range(len(names)) if i not in target_indices]
-
-    random.seed(595)
-    others_indices = random.sample(others_indices, len(target_indices))
 
-    subset_indices = target_indices + others_indices 
+    # use 75% of the target samples and an equal number of randomly
+    #   sampled other samples so the classes are balanced; the rest is
+    #   held out for testing.py, which picks the unlock threshold on it
+    #   (see splits.holdout_split())
+    subset_indices, _ = holdout_split(Y, test_size=0.25, seed=595)
     X_subset = X[subset_indices]
     Y_subset = Y[subset_indices]
 
-    # # separately split both lists into training and testing sets,
-    # #   - combine both training sets into one set
-    # #   - combine both testing sets into one set
-    # # this ensures that the overall training and testing sets will 
-    # #   have proportional amounts of target samples instead of 
-    # #   randomly splitting the entire dataset 
-    # target_ind_train, target_ind_test = train_test_split(target_indices, 
-    #                                                      test_size=0.25, 
-    #                                                      random_state=595)
-    # others_ind_train, others_ind_test = train_test_split(others_indices,
-    #                                                      test_size=0.25,
-    #                                                      random_state=595)
-
-    # train_indices = target_ind_train + others_ind_train 
-    # test_indices  = target_ind_test  + others_ind_test
-
-    # # use these lists to extract the actual training/testing data
-    # X_train = X[train_indices]
-    # X_test
-
     # train a model on the dataset and get the tuned parameters
     # params = lr.train(X, Y, w_path, b_path)
-    params = lr.train(X_subset, Y_subset, w_path, b_path)
-    w = params['w']
-    b = params['b']
-
-# use the device's camera to take a picture of the user
-# provide a box in the camera feed for the user to position 
-#   their head
-capture = capture_image(box_size=(250, 250))
-
-# if capture_image() returns None, then there was a problem
-#  getting the image from the camera. Exit the program.
-if not capture:
-    print('Error capturing picture.')
-    exit(1)
-
-# since box_size was specified as a parameter for the 
-#   capture_image() function, the returned value gives
-#   the coordinates and size of the box
-box_x = capture['x']
-box_y = capture['y']
-box_width = capture['width']
-box_height = capture['height']
-
-# to match the shape of the training data, the capture will
-#   be cropped so that only the selection in the box remains
-cropped_path = crop_image(file_path='captures/capture.jpg',
-                          x=box_x,
-                          y=box_y,
-                          width=box_width,
-                          height=box_height)
-
-# now the captured image is the same shape as the training images,
-#  but it has to be resized from (750x750) to match their size 
-resized_path = resize_image(file_path=cropped_path,
-                            output_path='captures/resized_capture.jpg',
-                            width=image_size[0],
-                            height=image_size[1])
-
-
-# store the resized image of the user's face
-face = cv2.imread(resized_path)
-#face = cv2.imread('captures/resized_capture.jpg')
-face = cv2.resize(face, image_size)
-#print(face)
-# using the weights and biases previously tuned by the training
-#   process, pass the face image into the classifier and get
-#   the predicted label as well as its probability
-class_results = lr.classification(face, w_path, b_path)
-face_label = class_results['label']
-face_prob  = class_results['prob']
-
-# if the returned label is 1 with a probability of at least 80%, 
+    params = lr.train(X_subset, Y_subset, w_path, b_path,
+                      preprocessor=preprocessor, **hyperparameters)
+
+    # store the tuned parameters and what they were trained on
+    #   together in the model artifact
+    Model(w_path, b_path).save_artifact(model_path,
+                                        input_shape=input_shape,
+                                        identities=[target_name],
+                                        threshold=0.7,
+                                        hyperparameters=hyperparameters,
+                                        data_hash=data_hash(X_subset, Y_subset))
+    model = Model(artifact_path=model_path, input_shape=input_shape)
+
+# when live_mode is True, the camera feed is checked continuously
+#   and the face is recognized as soon as enough consecutive frames
+#   pass the threshold; otherwise a single picture is taken after
+#   5 seconds and classified
+live_mode = True
+
+if live_mode:
+    # provide a box in the camera feed for the user to position
+    #   their head; the box is cropped and scored on every frame
+    result = recognize_stream(model,
+                              box_size=(250, 250),
+                              size=image_size,
+                              threshold=model.threshold,
+                              required_frames=5,
+                              timeout=30,
+                              detect=detect)
+
+    # if recognize_stream() returns None, then there was a problem
+    #  opening the camera. Exit the program.
+    if not result:
+        print('Error capturing picture.')
+        exit(1)
+
+    face_recognized = result['recognized']
+
+else:
+    # use the device's camera to take a picture of the user
+    # provide a box in the camera feed for the user to position 
+    #   their head
+    # the picture is kept in memory instead of being saved to disk
+    capture = capture_image(box_size=(250, 250), save=False)
+
+    # if capture_image() returns None, then there was a problem
+    #  getting the image from the camera. Exit the program.
+    if not capture:
+        print('Error capturing picture.')
+        exit(1)
+
+    # since box_size was specified as a parameter for the 
+    #   capture_image() function, the returned value gives
+    #   the coordinates and size of the box
+    box_x = capture['x']
+    box_y = capture['y']
+    box_width = capture['width']
+    box_height = capture['height']
+
+    # to match the shape of the training data, the capture will
+    #   be cropped so that only the selection in the box remains
+    cropped = crop_array(capture['frame'],
+                         x=box_x,
+                         y=box_y,
+                         width=box_width,
+                         height=box_height)
+
+    # now the captured image is the same shape as the training images,
+    #  but it has to be resized from (250x250) to match their size 
+    face = resize_array(cropped,
+                        width=image_size[0],
+                        height=image_size[1])
+
+    # or use the face detected in the whole frame, framed like the
+    #   detected faces the model was trained on
+    if detect:
+        face = extract_face(capture['frame'], image_size)
+
+    # using the weights and biases previously tuned by the training
+    #   process, pass the face image into the classifier and get
+    #   the predicted label as well as its probability
+    face_prob = model.predict_proba(face)
+    face_label = (face_prob >= 0.5) * 1.0
+
+    face_recognized = face_label == 1 and face_prob >= model.threshold
+
+# if the returned label is 1 with a probability of at least the model's
+#   threshold (picked on held-out data by testing.py and stored in
+#   the artifact, see evaluation.save_to_artifact()),
 #   we will say that the face in the image was correctly recognized 
 #   as the target person
 # if either of the following conditions is true, then we say that 
 #   the face in the image is not the target person
 #       1. predicted label is 0
-#       2. probability is less than 80%
+#       2. probability is less than the threshold
 #   in this case, prompt the user for a password to prove
 #     their identity
-if face_label == 1 and face_prob >= 0.7:
+if face_recognized:
     print(f'Face recognized as {target_name}.')
     print('Unlocking...')
 
@@ -165,8 +204,3 @@ else:
         print('Incorrect password.')
         print('Exiting program.')
         exit(2)
-
-# delete any files that were created
-clean_up('captures')
-
-    
@@ -0,0 +1,171 @@
+import numpy as np
+from load_images import load_dataset
+
+# number of rows converted to floating point at a time
+CHUNK_SIZE = 1024
+
+
+class FeatureStore:
+    """A read-only matrix of flattened uint8 pixel values
+
+    Holds the images of a dataset as a (num. samples, num. features)
+    uint8 array, normally a memory-mapped .npy file from the load_images
+    cache, instead of a float64 copy of the whole dataset. Indexing with
+    a slice, list or array of indices returns another FeatureStore that
+    shares the same pixel data, so taking subsets never copies the matrix.
+
+    The pixels are scaled to [0, 1] in float32 one chunk of rows at a time
+    inside dot() and T.dot(), which means the store can be passed anywhere
+    the code expects X and uses X.dot(w) / X.T.dot(v), e.g. propagate().
+    """
+
+    def __init__(self, data, indices=None, scale=1 / 255, chunk_size=CHUNK_SIZE):
+        # flatten the images into one row per sample
+        # (reshaping a contiguous array or memmap does not copy it)
+        self.data = data.reshape((data.shape[0], -1))
+        self.indices = None if indices is None else np.asarray(indices, dtype=np.intp)
+        self.scale = np.float32(scale)
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_folder(cls, folder, size=None, detect=False, **kwargs):
+        """Opens the cached pixels of a dataset folder as a FeatureStore
+
+        The folder is decoded by load_dataset the first time and then
+        memory-mapped from its cache, so only the rows that are actually
+        used get read from disk. detect is passed to load_dataset.
+        """
+        images, _ = load_dataset(folder, size=size, mmap_mode='r', detect=detect)
+        return cls(images, **kwargs)
+
+    @property
+    def shape(self):
+        rows = self.data.shape[0] if self.indices is None else len(self.indices)
+        return (rows, self.data.shape[1])
+
+    @property
+    def T(self):
+        return _TransposedStore(self)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """Returns a single uint8 row or a FeatureStore over a subset of rows"""
+
+        # a single integer gives back the raw pixel row
+        if isinstance(key, (int, np.integer)):
+            if self.indices is not None:
+                key = self.indices[key]
+            return self.data[key]
+
+        # slices of an unindexed store are plain views of the data
+        if isinstance(key, slice) and self.indices is None:
+            return FeatureStore(self.data[key], scale=self.scale,
+                                chunk_size=self.chunk_size)
+
+        # otherwise keep an array of row numbers into the shared data
+        rows = np.arange(self.data.shape[0]) if self.indices is None else self.indices
+        return FeatureStore(self.data, indices=rows[key], scale=self.scale,
+                            chunk_size=self.chunk_size)
+
+    def chunks(self, chunk_size=None):
+        """Yields (start, stop, X_chunk) for consecutive blocks of rows
+
+        X_chunk is a float32 array holding rows start:stop scaled to [0, 1].
+        The same buffer is reused for every chunk, so copy it if it needs
+        to outlive the next iteration.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        n, d = self.shape
+
+        raw = np.empty((min(chunk_size, n), d), dtype=self.data.dtype)
+        buf = np.empty((min(chunk_size, n), d), dtype=np.float32)
+
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            rows = stop - start
+
+            if self.indices is None:
+                block = self.data[start:stop]
+            else:
+                block = np.take(self.data, self.indices[start:stop], axis=0,
+                                out=raw[:rows])
+
+            np.multiply(block, self.scale, out=buf[:rows])
+            yield start, stop, buf[:rows]
+
+    def to_array(self, dtype=np.float32):
+        """Returns the scaled rows as an in-memory array"""
+        out = np.empty(self.shape, dtype=dtype)
+        for start, stop, chunk in self.chunks():
+            out[start:stop] = chunk
+        return out
+
+    def dot(self, w):
+        """Computes X @ w without materializing X as floating point"""
+        w = np.asarray(w, dtype=np.float32)
+        out = np.empty((self.shape[0],) + w.shape[1:], dtype=np.float32)
+
+        for start, stop, chunk in self.chunks():
+            np.dot(chunk, w, out=out[start:stop])
+
+        return out
+
+
+class _TransposedStore:
+    """The transpose of a FeatureStore, used to compute X.T @ v"""
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def shape(self):
+        return self.store.shape[::-1]
+
+    def dot(self, v):
+        """Computes X.T @ v one chunk of rows at a time"""
+        v = np.asarray(v, dtype=np.float32)
+        out = np.zeros((self.store.shape[1],) + v.shape[1:], dtype=np.float32)
+
+        for start, stop, chunk in self.store.chunks():
+            out += np.dot(chunk.T, v[start:stop])
+
+        return out
+
+
+def float_rows(X, dim=None, scale=1):
+    """Returns X as a float32 array of rows of pixel values in [0, 1]
+
+    X is a FeatureStore (which scales its own pixels) or an array, whose
+    values are multiplied by scale: 1 for arrays that are already in
+    [0, 1] and 1 / 255 for uint8 images. With dim, the number of values
+    in one image, a single image becomes one row and images of any other
+    size raise a ValueError.
+
+    This is the one place the rest of the code turns images into the
+    rows the models work with, so they all agree on the pixels' scale.
+    """
+    if hasattr(X, 'to_array'):
+        return X.to_array()
+
+    X = np.asarray(X)
+    if dim is not None and X.size == dim:
+        X = X.reshape((1, dim))
+    else:
+        X = X.reshape((X.shape[0], -1))
+
+    if dim is not None and X.shape[1] != dim:
+        raise ValueError(f'Expected images with {dim} values, got {X.shape[1]}')
+
+    if scale == 1:
+        return X.astype(np.float32, copy=False)
+    return np.multiply(X, np.float32(scale), dtype=np.float32)
+
+
+def raw_rows(X, rows):
+    """Returns the unscaled rows of a FeatureStore or an array of images"""
+    if isinstance(X, FeatureStore):
+        rows = rows if X.indices is None else X.indices[rows]
+        return np.take(X.data, rows, axis=0)
+    return np.asarray(X[rows])
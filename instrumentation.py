@@ -0,0 +1,234 @@
+import io
+import json
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import contextlib
+import tracemalloc
+from atomic_file import atomic_write
+
+# metrics are only recorded after enable() is called; until then every
+#   timer, counter and observation returns immediately
+_enabled = False
+_lock = threading.Lock()
+
+# name --> [count, total seconds, min seconds, max seconds]
+_timers = {}
+
+# name --> value
+_counters = {}
+
+# name --> list of (step, value), e.g. the loss at every iteration
+_series = {}
+
+
+def enable():
+    """Starts recording metrics"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stops recording metrics (the ones recorded so far are kept)"""
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """Forgets every recorded metric"""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _series.clear()
+
+
+def _record_time(name, seconds):
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = min(stats[2], seconds)
+            stats[3] = max(stats[3], seconds)
+
+
+class _Timer:
+    """Times the body of a with statement, see timer()"""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    """Stands in for _Timer while recording is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """Returns a context manager that times its body under name
+
+    e.g.
+        with timer('load.decode'):
+            img = cv2.imread(path)
+
+    While recording is disabled this returns a shared no-op object, so
+    leaving timers in hot loops costs almost nothing.
+    """
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def timed(name):
+    """Decorator that times every call of a function under name"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _record_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """Adds value to the counter name"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value, step=None):
+    """Records one value of the series name, e.g. the loss at a step"""
+    if not _enabled:
+        return
+    with _lock:
+        series = _series.setdefault(name, [])
+        series.append((len(series) if step is None else step, float(value)))
+
+
+def snapshot():
+    """Returns every recorded metric as a plain dictionary"""
+    with _lock:
+        timers = {name: {'count': c, 'total': total, 'mean': total / c,
+                         'min': low, 'max': high}
+                  for name, (c, total, low, high) in _timers.items()}
+        return {'timers': timers,
+                'counters': dict(_counters),
+                'series': {name: list(values) for name, values in _series.items()}}
+
+
+def write_json_lines(path):
+    """Appends the metrics to path, one JSON object per metric
+
+    Every line has a timestamp, the metric's type ('timer', 'counter' or
+    'series') and name, and its values.
+    """
+    metrics = snapshot()
+    now = time.time()
+
+    with open(path, 'a') as f:
+        for kind, key in [('timer', 'timers'), ('counter', 'counters'), ('series', 'series')]:
+            for name, value in metrics[key].items():
+                f.write(json.dumps({'time': now, 'type': kind,
+                                    'name': name, 'value': value}) + '\n')
+
+
+def _prometheus_name(name):
+    return 'faceid_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def write_prometheus(path):
+    """Writes the metrics to path in the Prometheus text format
+
+    Timers become summaries (_count and _sum in seconds), counters become
+    counters, and each series is reported as a gauge of its last value.
+    The file is written to a temporary path and renamed, so it can be
+    read by the node exporter's textfile collector at any time.
+    """
+    metrics = snapshot()
+    lines = []
+
+    for name, stats in metrics['timers'].items():
+        metric = _prometheus_name(name) + '_seconds'
+        lines += [f'# TYPE {metric} summary',
+                  f'{metric}_count {stats["count"]}',
+                  f'{metric}_sum {stats["total"]:.9f}']
+
+    for name, value in metrics['counters'].items():
+        metric = _prometheus_name(name) + '_total'
+        lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+
+    for name, values in metrics['series'].items():
+        if values:
+            metric = _prometheus_name(name)
+            lines += [f'# TYPE {metric} gauge', f'{metric} {values[-1][1]}']
+
+    with atomic_write(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+@contextlib.contextmanager
+def profile(path=None, memory=False, top=25):
+    """Profiles the body of a with statement with cProfile
+
+    The top functions by cumulative time are printed, and the raw stats
+    are saved to path if given (open them with pstats or snakeviz). With
+    memory = True, tracemalloc also records where memory is allocated and
+    the top allocation sites are printed. Both slow the code down a lot,
+    so this is only meant to be switched on while investigating.
+    """
+    profiler = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        print(out.getvalue())
+        if path:
+            profiler.dump_stats(path)
+
+        if memory:
+            allocations = tracemalloc.take_snapshot().statistics('lineno')
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f'Memory: {current / 2**20:.1f} MiB in use, {peak / 2**20:.1f} MiB peak')
+            for stat in allocations[:top]:
+                print(stat)
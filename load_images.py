@@ -1,69 +1,353 @@
 import os
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import cv2
 from pic_ops import resize_image
-from tqdm import tqdm 
+from tqdm import tqdm
+from instrumentation import timer, count
+from detection import extract_face
+from atomic_file import atomic_write, save_array
 
-def load_images_from_folder(folder, size=None):
+# directory where decoded datasets are stored between runs
+CACHE_DIR = '.cache'
+
+
+def _scan_person_folder(path):
+    """Lists the files in one person's folder with their sizes and mtimes"""
+    files, sizes, mtimes = [], [], []
+
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+
+    for entry in entries:
+        # if the current path is not a valid file, don't process it
+        if not entry.is_file():
+            print(f'{entry.path} is not a valid file.')
+            continue
+
+        st = entry.stat()
+        files.append(entry.name)
+        sizes.append(st.st_size)
+        mtimes.append(st.st_mtime_ns)
+
+    return files, sizes, mtimes
+
+
+def _restat_files(path, files):
+    """Re-reads the sizes and mtimes of the known files in a person's folder
+
+    Used when the folder itself didn't change, i.e. no files were added,
+    removed or renamed, but images might have been overwritten in place.
+    Returns None if one of the files is gone, so the folder is re-scanned.
+    """
+    sizes, mtimes = [], []
+    for name in files:
+        try:
+            st = os.stat(os.path.join(path, name))
+        except FileNotFoundError:
+            return None
+        sizes.append(st.st_size)
+        mtimes.append(st.st_mtime_ns)
+
+    return list(files), sizes, mtimes
+
+
+def _manifest_path(folder, cache_dir):
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{key}.manifest.npz')
+
+
+def scan_folder(folder, cache_dir=CACHE_DIR):
+    """Builds an index (manifest) of every image in a dataset folder
+
+    The person-specific folders inside folder are listed in alphabetical
+    order with one os.scandir pass, and the files inside each of them
+    are sorted as well, so that the pixels and the labels of the dataset
+    always line up. Each person's folder name is their identity.
+
+    The manifest is a dictionary of numpy arrays (columns):
+        - identities: the name of every person-specific folder
+        - dir_mtimes: the modification time of each of those folders
+        - files:      the file name of every image
+        - ids:        the index into identities of every image
+        - sizes:      the size in bytes of every image
+        - mtimes:     the modification time of every image
+
+    It is saved in cache_dir, and later calls only list the folders whose
+    modification time changed, i.e. folders where images were added,
+    removed or renamed. The files of the other folders are still stat'ed
+    (which is cheap next to decoding them), so images that were
+    overwritten in place get their new size and mtime. Set cache_dir =
+    None to always scan everything.
+    """
+
+    # reuse the rows of folders that didn't change since the last scan
+    previous = {}
+    manifest_path = _manifest_path(folder, cache_dir) if cache_dir else None
+    if manifest_path and os.path.exists(manifest_path):
+        # read each column once (every access to an npz file re-reads it)
+        with np.load(manifest_path) as npz:
+            old = {column: npz[column] for column in npz.files}
+
+        bounds = np.searchsorted(old['ids'], np.arange(len(old['identities']) + 1))
+        for i, name in enumerate(old['identities']):
+            rows = slice(bounds[i], bounds[i + 1])
+            previous[str(name)] = (int(old['dir_mtimes'][i]),
+                                   old['files'][rows],
+                                   old['sizes'][rows],
+                                   old['mtimes'][rows])
+
+    # get an alphabetically sorted list of the folders to iterate through
+    # and filter out any file folders with '.' in the name (ex. .DS_store)
+    with os.scandir(folder) as it:
+        folderlist = sorted((e for e in it if '.' not in e.name),
+                            key=lambda e: e.name.casefold())
+
+    identities, dir_mtimes = [], []
+    files, ids, sizes, mtimes = [], [], [], []
+
+    for entry in folderlist:
+
+        # if the current path is not a valid directory, don't process it
+        if not entry.is_dir():
+            print(f'{entry.path} is not a valid directory.')
+            continue
+
+        dir_mtime = entry.stat().st_mtime_ns
+
+        scanned = None
+        if entry.name in previous and previous[entry.name][0] == dir_mtime:
+            scanned = _restat_files(entry.path, previous[entry.name][1])
+        if scanned is None:
+            scanned = _scan_person_folder(entry.path)
+        f, sz, mt = scanned
+
+        files.append(np.asarray(f, dtype=str))
+        sizes.append(np.asarray(sz, dtype=np.int64))
+        mtimes.append(np.asarray(mt, dtype=np.int64))
+        ids.append(np.full(len(f), len(identities), dtype=np.int32))
+        identities.append(entry.name)
+        dir_mtimes.append(dir_mtime)
+
+    manifest = {'identities': np.asarray(identities, dtype=str),
+                'dir_mtimes': np.asarray(dir_mtimes, dtype=np.int64),
+                'files': np.concatenate(files) if files else np.array([], dtype=str),
+                'ids': np.concatenate(ids) if ids else np.array([], dtype=np.int32),
+                'sizes': np.concatenate(sizes) if sizes else np.array([], dtype=np.int64),
+                'mtimes': np.concatenate(mtimes) if mtimes else np.array([], dtype=np.int64)}
+
+    if manifest_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_write(manifest_path) as f:
+            np.savez_compressed(f, **manifest)
+
+    return manifest
+
+
+def manifest_paths(folder, manifest):
+    """Returns the full path of every image in a manifest"""
+    dirs = manifest['identities']
+    return [os.path.join(folder, dirs[i], f)
+            for i, f in zip(manifest['ids'], manifest['files'])]
+
+
+def _read_image(filepath, size=None, color=cv2.IMREAD_COLOR, detect=False):
+    """Reads and optionally resizes a single image file
+
+    With detect = True (and a size), the face in the image is found and
+    its aligned crop is resized instead of the whole image, see
+    detection.extract_face().
+
+    This runs on the decoding threads of load_dataset, which share the
+    process's metrics, so the timers below are recorded as usual.
+
+    Returns the decoded uint8 array
+    """
+    with timer('load.decode'):
+        img = cv2.imread(filepath, color)
+
+    if img is None:
+        raise ValueError(f'Could not read image {filepath}')
+
+    # if the size paramater has a value, resize the image
+    # to those dimensions
+    if size and detect:
+        with timer('load.detect'):
+            img = extract_face(img, size)
+    elif size:
+        w, h = size
+        with timer('load.resize'):
+            img = cv2.resize(img, (w, h))
+
+    return img
+
+
+def _cache_key(manifest, size, color, detect=False):
+    """Builds a key that identifies a decoded version of a dataset
+
+    The key is a hash of every file's name, size and modification time
+    in the manifest together with the requested image size and color
+    mode (and whether faces were detected), so adding, removing or editing
+    any image produces a different key.
+    """
+    h = hashlib.sha1()
+    h.update(repr((size, color, 'detect') if detect else (size, color)).encode())
+
+    for column in ['identities', 'files', 'ids', 'sizes', 'mtimes']:
+        h.update(np.ascontiguousarray(manifest[column]).tobytes())
+
+    return h.hexdigest()[:16]
+
+
+def _cache_prefix(folder, size, color, detect=False):
+    """Builds the prefix shared by every cached version of a dataset
+
+    It identifies the folder and the decoding settings but not the
+    folder's contents, so when the contents change, the files of the
+    previous version can be found (and removed) by their prefix.
+    """
+    settings = (os.path.abspath(folder), size, color, detect)
+    return hashlib.sha1(repr(settings).encode()).hexdigest()[:16]
+
+
+def _remove_stale_versions(cache_dir, prefix, key):
+    """Deletes the cached images and names of older versions of a dataset"""
+    for entry in os.scandir(cache_dir):
+        name = entry.name
+        if (name.startswith(f'{prefix}.') and name.endswith(('.images.npy', '.names.npy'))
+                and not name.startswith(f'{prefix}.{key}.')):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                # another process already removed it, or (on Windows) it
+                #   is still memory-mapped; it is retried next time
+                pass
+
+
+def load_dataset(folder, size=None, color=cv2.IMREAD_COLOR,
+                 cache_dir=CACHE_DIR, workers=None, mmap_mode=None, detect=False):
+    """Loads a dataset folder as a uint8 tensor of images and an array of names
+
+    Decodes and resizes every image listed by scan_folder() using a
+    pool of threads (one per core unless workers is given) and stacks
+    them into a single (num. images, height, width, channels) uint8
+    array. OpenCV releases the GIL while it decodes and resizes, so the
+    threads run in parallel, and unlike worker processes they don't
+    re-import the calling script, which face_id.py and testing.py aren't
+    guarded against (e.g. with the spawn start method on macOS and
+    Windows).
+
+    The result is cached in cache_dir, keyed by the folder's contents,
+    size and color, so later runs with the same data skip decoding
+    entirely. Only the newest version of each folder is kept for each
+    size and color, the files of older ones are deleted when a new one
+    is written. Set cache_dir = None to disable the cache. mmap_mode is
+    passed to np.load when reading from the cache, e.g. 'r' to get a
+    read-only memory-mapped array instead of reading it into RAM.
+
+    With detect = True, every image is replaced by the aligned crop of the
+    face in it (see detection.extract_face()), framed the same way as the
+    faces that pic_ops.recognize_stream(detect=True) finds in the camera
+    feed. This requires a size.
+
+    Returns the images and a numpy array of the corresponding names
+    """
+
+    if detect and not size:
+        raise ValueError('Detecting faces requires a size to resize them to')
+
+    manifest = scan_folder(folder, cache_dir)
+
+    if not len(manifest['files']):
+        raise ValueError(f'No images found in {folder}')
+
+    if cache_dir:
+        prefix = _cache_prefix(folder, size, color, detect)
+        key = _cache_key(manifest, size, color, detect)
+        images_path = os.path.join(cache_dir, f'{prefix}.{key}.images.npy')
+        names_path = os.path.join(cache_dir, f'{prefix}.{key}.names.npy')
+
+        # warm run: the dataset was already decoded with these settings
+        if os.path.exists(images_path) and os.path.exists(names_path):
+            print(f'Reading cached folder: {folder}')
+            count('load.cache_hits')
+            images = np.load(images_path, mmap_mode=mmap_mode)
+            names = np.load(names_path)
+            return images, names
+
+    print(f'Reading folder: {folder}')
+
+    paths = manifest_paths(folder, manifest)
+    names = manifest['identities'][manifest['ids']]
+    read = functools.partial(_read_image, size=size, color=color, detect=detect)
+
+    workers = workers or os.cpu_count() or 1
+
+    count('load.images_decoded', len(paths))
+
+    # decode the first image up front to find the shape of the tensor
+    first = read(paths[0])
+    images = np.empty((len(paths),) + first.shape, dtype=np.uint8)
+    images[0] = first
+
+    def decode(i):
+        # every thread writes straight into its row of the tensor
+        images[i] = read(paths[i])
+
+    with timer('load.decode_all'):
+        if workers == 1:
+            for i in tqdm(range(1, len(paths))):
+                decode(i)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                jobs = [pool.submit(decode, i) for i in range(1, len(paths))]
+                try:
+                    for job in tqdm(as_completed(jobs), total=len(jobs)):
+                        job.result()
+                finally:
+                    for job in jobs:
+                        job.cancel()
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_array(images_path, images)
+        save_array(names_path, names)
+        _remove_stale_versions(cache_dir, prefix, key)
+
+        if mmap_mode:
+            images = np.load(images_path, mmap_mode=mmap_mode)
+
+    return images, names
+
+
+def load_images_from_folder(folder, size=None, detect=False):
     """Loads a set of images from a given directory
 
     Searches for the directory specified by folder and
-    loads all the '.jpg' files found in the folder into 
-    a python list. 
+    loads all the '.jpg' files found in the folder into
+    a python list.
 
-    If the images need to be resized, the function 
-    accepts a tuple in the form (width, height) as 
-    size parameter. These values represent the 
+    If the images need to be resized, the function
+    accepts a tuple in the form (width, height) as
+    size parameter. These values represent the
     dimensions of the resized image.
-    """
-    
-    # create a list to hold the data for each image
-    images = []
 
-    # get an alphabetically sorted list of the folders to iterate through
-    folderlist = sorted(os.listdir(folder), key=str.casefold)
+    The images are decoded in parallel and cached on disk
+    by load_dataset, so only the first call for a given
+    folder and size has to read the '.jpg' files.
 
-    # filter out any file folders with '.' in the name (ex. .DS_store)
-    folderlist = list(filter(lambda f: '.' not in f, folderlist))
+    With detect = True, only the detected face in each
+    image is kept (see load_dataset).
+    """
 
     try:
-        print(f'Reading folder: {folder}')
-        # iterate through the list of directories in folder
-        for foldername in tqdm(folderlist):
-
-            # access the person-specific folders by appending
-            # the current folder's name to the overall folder's name
-            folderpath = os.path.join(folder, foldername)
-
-            # if the current path is not a valid directory, don't process it
-            if not os.path.isdir(folderpath):
-                print(f'{folderpath} is not a valid directory.')
-                continue
-
-            # iterate through the list of files in the 
-            # person-specific folder
-            for filename in os.listdir(folderpath):
-
-                # determine the filepath by appending the file's
-                # name to the encompassing folder's path
-                filepath = os.path.join(folderpath, filename)
-
-                # if the current path is not a valid file, don't process it
-                if not os.path.isfile(filepath):
-                    print(f'{filepath} is not a valid file.')
-                    continue 
-                
-                img = cv2.imread(filepath)
-
-                # if the size paramater has a value, resize the image 
-                # to those dimensions
-                if size:
-                    w, h = size 
-                    img = cv2.resize(img, (w, h))
-
-                images.append(img)
-
-        return images
-            
+        images, _ = load_dataset(folder, size=size, detect=detect)
+
+        # each entry of the list is a view into the stacked tensor
+        return list(images)
+
     # handle any errors that occur during the process
     except Exception as e:
         print(f'Error loading {folder}')
@@ -76,31 +360,16 @@ def load_image_names_from_folder(folder):
     of people's names found in the names of each file in the directory.
     """
 
-    # make a list to hold the names found
-    names = []
-
-    # get an alphabetically sorted list of the folders to iterate through
-    folderlist = sorted(os.listdir(folder), key=str.casefold)
-
-    # filter out any file folders with '.' in the name (ex. .DS_store)
-    folderlist = list(filter(lambda f: '.' not in f, folderlist))
-
     try:
 
-        # iterate through the main directory to find the folders named 
-        # after people
-        for foldername in folderlist:
-
-            # each person-named folder contains images of that person
-            # for each folder, iterate through the image files and 
-            #   extract the human name from the complete file path
-            folderpath = os.path.join(folder, foldername)
-            for filename in os.listdir(folderpath):
-                name = filename[:filename.rfind("_")]
-                names.append(name)
-        
+        # each person-named folder contains images of that person
+        # the names come from the folder's manifest, in the same
+        #   order that load_images_from_folder uses
+        manifest = scan_folder(folder)
+        names = manifest['identities'][manifest['ids']].tolist()
+
         return names
-    
+
     # handle any errors that occur during the process
     except Exception as e:
-        print(e)
\ No newline at end of file
+        print(e)
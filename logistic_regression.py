@@ -1,17 +1,41 @@
+import os
+import time
 import numpy as np 
 import scipy
+import scipy.io
+import scipy.optimize
+import scipy.special
 from tqdm import tqdm
-
-def sigmoid(z):
+import instrumentation
+from instrumentation import timer
+from model import Model, MulticlassModel
+from preprocessing import preprocessor_path
+from feature_store import float_rows
+from checkpoint import (checkpoint_prefix, save_checkpoint, load_checkpoint,
+                        check_checkpoint, clear_checkpoints)
+
+# largest FeatureStore (in bytes of float32) that gradient descent converts
+#   to an in-memory array instead of scaling its chunks every iteration
+IN_MEMORY_BYTES = 1 << 30
+
+def sigmoid(z, out=None):
     """Returns a probability value [0, 1] for an input z
 
     Passes z as an input into the sigmoid function,
         sigmoid(z) = 1 / (1 + e^-z)
     and returns the output value which ranges from 0 to 1
+
+    scipy.special.expit computes this without overflowing for large
+    negative z. If out is given, the result is written into it.
     """
-    return 1 / (1 + np.exp(-z))
+    return scipy.special.expit(z, out=out)
+
 
 
+# models loaded by classification() and multiclass_classification(),
+#   keyed by their parameter files
+_models = {}
+
 
 def classification(image, w_path, b_path):
     """Assigns a label to input image based on a previously trained model
@@ -22,25 +46,22 @@ def classification(image, w_path, b_path):
     This essentially uses the training data as a basis for figuring out the 
     probability that the input image belongs to a specific class.
 
+    The terms are only read from their files the first time a pair of
+    paths is used (or after the files change), see model.Model.
+
     The assigned label and its probability are returned from the function
     """
 
-    # obtain w and b from their respective files
-    w = scipy.io.loadmat(w_path)['weights']
-    b = scipy.io.loadmat(b_path)['biases']
-
-    # reshape photo data
-    X = image.reshape((1, np.prod(image.shape[0:3])))
-
-    # flatten the data
-    X = X / 255
-    print('X shape: ', X.shape)
-    print('w shape: ', w.shape)
+    # obtain the model for w and b, loading it if necessary
+    model = _models.get((w_path, b_path))
+    if model is None:
+        model = _models[(w_path, b_path)] = Model(w_path, b_path)
+    else:
+        model.reload_if_changed()
 
     # calculate probabilities for testing data 
-    # A = 1 / (1 + np.exp(-(np.dot(X, w) + b)))
-    A = sigmoid(np.dot(X, w) + b)
-    print("PROBABILITY: ", A)
+    A = model.predict_proba(image)
+
     # assign labels to the samples using their probabilities
     Y = (A >= 0.5) * 1.0
 
@@ -54,7 +75,8 @@ def propagate(w, b, X, Y):
     Arguments:
     w: weights - numpy array of size (num_px * num_px * 3, 1)
     b: bias - scalar
-    X: data of size (num. samples, num_px * num_px * 3)
+    X: data of size (num. samples, num_px * num_px * 3), either a numpy
+       array or a FeatureStore
     Y: true "label" vector
 
     Return:
@@ -65,50 +87,660 @@ def propagate(w, b, X, Y):
     m = X.shape[0]
 
     # Forward propagation (X -> cost)
-    A = sigmoid(np.dot(X, w) + b)
+    with timer('train.forward'):
+        A = sigmoid(X.dot(w) + b)
 
     # Backward propagation (to find gradient)
-    dw = (np.dot(X.T, (A-Y))) / m 
-    db = (np.sum(A-Y)) / m 
+    A -= Y
+    with timer('train.backward'):
+        dw = (X.T.dot(A)) / m
+    db = (np.sum(A)) / m
 
     return dw, db 
 
 
-def train(X_train, y_train, w_path, b_path):
+class GradientKernel:
+    """Computes the same gradient as propagate() without allocating memory
+
+    The buffers for X.dot(w) (num. samples, 1) and the gradient dw are
+    allocated once, and every step is computed in place in them, so a
+    training step only streams through X twice and never calls the
+    memory allocator. Everything is computed in dtype (e.g. float32,
+    which halves the memory traffic of float64); X and Y are converted
+    once here if they are arrays of another dtype.
+
+    The returned dw is the kernel's own buffer, so it is overwritten by
+    the next call to gradient(). With with_cost = True, gradient() also
+    stores the cost of w and b in the cost attribute.
+    """
+
+    def __init__(self, X, Y, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        if isinstance(X, np.ndarray):
+            X = X.astype(self.dtype, copy=False)
+        self.X = X
+        self.Y = np.asarray(Y, dtype=self.dtype).reshape((-1, 1))
+
+        m, dim = X.shape
+        self.m = m
+        self.z = np.empty((m, 1), dtype=self.dtype)
+        self.dw = np.empty((dim, 1), dtype=self.dtype)
+
+    def gradient(self, w, b, with_cost=False):
+        """Returns dw and db for the weights w (of the kernel's dtype) and b"""
+        z, dw = self.z, self.dw
+
+        # Forward propagation (X -> cost)
+        with timer('train.forward'):
+            if isinstance(self.X, np.ndarray):
+                np.dot(self.X, w, out=z)
+            else:
+                # e.g. a FeatureStore, which computes its product chunk by chunk
+                z[...] = self.X.dot(w)
+        z += b
+        if with_cost:
+            self.cost = float(np.sum(np.logaddexp(0, z) - self.Y * z)) / self.m
+        sigmoid(z, out=z)
+
+        # Backward propagation (to find gradient)
+        z -= self.Y
+        with timer('train.backward'):
+            if isinstance(self.X, np.ndarray):
+                np.dot(self.X.T, z, out=dw)
+            else:
+                dw[...] = self.X.T.dot(z)
+        dw *= 1 / self.m
+        db = float(np.sum(z)) / self.m
+
+        return dw, db
+
+
+def initial_params(init, dim):
+    """Returns the starting weights and bias for training
+
+    init is None (start from zeros), a model.Model, or a dictionary with
+    'w' and 'b'. The weights are copied, so training never modifies the
+    initial model.
+    """
+    if init is None:
+        return np.zeros((dim, 1)), 0.0
+
+    if isinstance(init, dict):
+        w, b = init['w'], init['b']
+    else:
+        w, b = init.w, init.b
+
+    w = np.array(w, dtype=np.float64).reshape((-1, 1))
+    if w.shape[0] != dim:
+        raise ValueError(f'The initial weights have {w.shape[0]} rows, '
+                         f'but the data has {dim} features')
+
+    return w, float(np.ravel(b)[0])
+
+
+def loss_and_gradient(params, X, Y):
+    """Computes the cost function and its gradient for a flat parameter vector
+
+    params holds the weights followed by the bias, i.e. [w; b], which is
+    the form scipy.optimize works with. The gradient is the same one
+    propagate() computes, and the cost is the mean cross-entropy loss
+    computed from z directly so that it never takes the log of 0.
+    """
+
+    m = X.shape[0]
+    w = params[:-1].reshape((-1, 1))
+    b = params[-1]
+
+    # Forward propagation (X -> cost)
+    with timer('train.forward'):
+        z = X.dot(w) + b
+    A = sigmoid(z)
+    cost = np.sum(np.logaddexp(0, z) - Y * z) / m
+
+    # Backward propagation (to find gradient)
+    with timer('train.backward'):
+        dw = (X.T.dot(A-Y)) / m
+    db = (np.sum(A-Y)) / m
+
+    grad = np.append(np.ravel(dw), db).astype(np.float64)
+    return float(cost), grad
+
+
+def hessian_vector_product(params, v, X, Y):
+    """Multiplies the Hessian of the cost function by a vector v
+
+    The Hessian of the cross-entropy loss is X^T S X / m, where S holds
+    A * (1 - A) on its diagonal. It is never formed explicitly; instead
+    v (split into its weight and bias parts like params) is pushed
+    through X and back, which costs two matrix-vector products.
+    """
+
+    m = X.shape[0]
+    w = params[:-1].reshape((-1, 1))
+    b = params[-1]
+    vw = v[:-1].reshape((-1, 1))
+    vb = v[-1]
+
+    A = sigmoid(X.dot(w) + b)
+    s = A * (1 - A) * (X.dot(vw) + vb)
+
+    hw = X.T.dot(s) / m
+    hb = np.sum(s) / m
+
+    return np.append(np.ravel(hw), hb).astype(np.float64)
+
+
+def cost(w, b, X, Y):
+    """Returns the mean cross-entropy loss of the parameters w and b on X, Y"""
+    z = X.dot(w) + b
+    return float(np.sum(np.logaddexp(0, z) - Y * z) / X.shape[0])
+
+
+@instrumentation.timed('train')
+def train(X_train, y_train, w_path, b_path, solver='gd', num_iterations=15000,
+          learning_rate=0.0005, tol=1e-5, preprocessor=None, init=None,
+          checkpoint_every=None, resume=False, dtype=None):
     """Trains a logistic regression classifier on the given training data
 
-    Performs gradient descent to optimize the the weight and bias parameters
-    in the sigmoid function using the training data as a basis.
+    Optimizes the the weight and bias parameters in the sigmoid function
+    using the training data as a basis. solver selects the algorithm:
+        - 'gd':        gradient descent with a fixed learning_rate
+        - 'lbfgs':     the L-BFGS quasi-Newton method
+        - 'newton-cg': Newton's method with conjugate gradient steps
+
+    Training stops after num_iterations iterations or once the solver
+    has converged to within tol (for gradient descent, once the norm of
+    the gradient falls below tol).
+
+    If a preprocessing.Preprocessor is given, it is fit to X_train (unless
+    it already was) and the model is trained on the transformed features.
+    The preprocessor is saved next to the weights (see preprocessor_path())
+    so that model.Model applies the same transform when classifying.
+
+    To continue optimizing a previously trained model instead of starting
+    from zeros, pass it as init: either a model.Model (e.g. loaded from
+    an artifact) or a dictionary with 'w' and 'b' like the one returned
+    by this function. A Model's preprocessor is reused unless another
+    preprocessor is given.
+
+    With checkpoint_every = n, a snapshot of the parameters, the iteration
+    number and the loss curve (the cost at every checkpoint) is saved every
+    n iterations next to the weights (see checkpoint.checkpoint_prefix()).
+    resume = True continues from the newest snapshot instead of starting
+    over; L-BFGS and Newton-CG rebuild their curvature estimates from the
+    snapshot's parameters, so only gradient descent resumes exactly. A
+    snapshot of another solver or of train_streaming() raises a ValueError.
+
+    Gradient descent runs on a GradientKernel and updates w in place. dtype
+    is the floating point type it computes in; by default the dtype of
+    X_train if that is a float array (float32 for a FeatureStore or the
+    output of a preprocessor), otherwise float64. A FeatureStore of up to
+    IN_MEMORY_BYTES of float32 values is converted to an array once first.
+
+    When instrumentation is enabled, the loss and gradient norm of every
+    iteration are recorded as the 'train.loss' and 'train.grad_norm' series.
 
     The optimized weight and bias terms are saved to the current directory 
-    in separate files as well as returned from the function in a dictionary
+    in separate files as well as returned from the function in a dictionary,
+    together with the number of iterations and the training time in seconds
     """
 
+    if solver not in ('gd', 'lbfgs', 'newton-cg'):
+        raise ValueError(f'Unknown solver: {solver}')
+
+    # reuse the preprocessor the initial model was trained with
+    if preprocessor is None and getattr(init, 'preprocessor', None) is not None:
+        preprocessor = init.preprocessor
+
+    if preprocessor is not None:
+        if not preprocessor.fitted:
+            preprocessor.fit(X_train)
+
+        # a FeatureStore holds uint8 pixels, arrays are already in [0, 1]
+        if hasattr(X_train, 'chunks'):
+            X_train = preprocessor.transform(X_train)
+        else:
+            X_train = preprocessor.transform_rows(np.asarray(X_train, dtype=np.float32))
+
+        preprocessor.save(preprocessor_path(w_path))
+    elif os.path.exists(preprocessor_path(w_path)):
+        # don't leave a stale preprocessor behind for the new weights
+        os.remove(preprocessor_path(w_path))
+
     # num. dims (cols) for each sample
     dim = X_train.shape[1]
 
-    # initialize weights vector
-    w = np.zeros((dim, 1))
+    print(f'Training model ({solver})....')
+    t1 = time.time()
+
+    # initialize weights vector and bias term
+    w, b = initial_params(init, dim)
+
+    # the cost at every checkpoint, as (iteration, cost) pairs
+    losses = []
+    iterations = 0
+
+    prefix = checkpoint_prefix(w_path)
+    state = load_checkpoint(prefix) if resume else None
+    if state is not None:
+        check_checkpoint(state, kind='train', solver=solver)
+        w, b = initial_params({'w': state['w'], 'b': state['b']}, dim)
+        iterations = int(state['iteration'])
+        losses = [tuple(row) for row in state['losses']]
+    elif checkpoint_every:
+        # old snapshots of another run must not be resumed later
+        clear_checkpoints(prefix)
+
+    def checkpoint(w, b):
+        losses.append((iterations, cost(w, b, X_train, y_train)))
+        save_checkpoint(prefix, iterations, {'kind': 'train',
+                                             'solver': solver,
+                                             'w': w,
+                                             'b': b,
+                                             'losses': np.array(losses).reshape((-1, 2))})
+
+    if solver == 'gd':
+        # a FeatureStore rescales every chunk on each pass, so convert it
+        #   once when it fits and let the kernel work on the array in place
+        if hasattr(X_train, 'chunks') and X_train.shape[0] * X_train.shape[1] * 4 <= IN_MEMORY_BYTES:
+            X_train = float_rows(X_train)
+
+        if dtype is None:
+            dtype = getattr(X_train, 'dtype', np.float32)
+            if not np.issubdtype(dtype, np.floating):
+                dtype = np.float64
+
+        kernel = GradientKernel(X_train, y_train, dtype)
+        w = w.astype(kernel.dtype)
+        flat_dw = kernel.dw.reshape(-1)
+
+        # record the loss and gradient norm of every iteration when
+        #   instrumentation is on (this costs one extra pass over z)
+        track = instrumentation.enabled()
+
+        for i in tqdm(range(iterations, num_iterations)):
+            dw, db = kernel.gradient(w, b, with_cost=track)
+            iterations += 1
+
+            if tol or track:
+                grad_norm = np.sqrt(np.dot(flat_dw, flat_dw) + db ** 2)
+            if track:
+                instrumentation.observe('train.loss', kernel.cost, iterations)
+                instrumentation.observe('train.grad_norm', grad_norm, iterations)
+
+            # stop early once the gradient has (nearly) vanished
+            if tol and grad_norm < tol:
+                break
+
+            # gradient descent (in place, dw is overwritten next step anyway)
+            dw *= learning_rate
+            w -= dw
+            b = b - (learning_rate * db)
+
+            if checkpoint_every and iterations % checkpoint_every == 0:
+                checkpoint(w, b)
+
+    elif iterations < num_iterations:
+        method = 'L-BFGS-B' if solver == 'lbfgs' else 'Newton-CG'
+        hessp = hessian_vector_product if solver == 'newton-cg' else None
+
+        # the norm of the last gradient scipy asked for, which is the
+        #   gradient at the new parameters when an iteration ends
+        grad_norm = None
+
+        def fun(params, X, Y):
+            nonlocal grad_norm
+            value, grad = loss_and_gradient(params, X, Y)
+            grad_norm = np.linalg.norm(grad)
+            return value, grad
+
+        # called by scipy with the parameters and cost after every iteration
+        def callback(intermediate_result):
+            nonlocal iterations
+            iterations += 1
+            instrumentation.observe('train.loss', intermediate_result.fun, iterations)
+            instrumentation.observe('train.grad_norm', grad_norm, iterations)
+
+            params = intermediate_result.x
+            if checkpoint_every and iterations % checkpoint_every == 0:
+                checkpoint(params[:-1].reshape((dim, 1)), params[-1])
+
+        result = scipy.optimize.minimize(fun,
+                                         np.append(np.ravel(w), b),
+                                         args=(X_train, y_train),
+                                         method=method,
+                                         jac=True,
+                                         hessp=hessp,
+                                         tol=tol,
+                                         callback=callback,
+                                         options={'maxiter': num_iterations - iterations})
+
+        w = result.x[:-1].reshape((dim, 1))
+        b = result.x[-1]
+
+    elapsed = time.time() - t1
+    print(f'Finished {iterations} iterations in {elapsed:.2f} seconds')
+
+    # save the final weight and bias terms to their respective files
+    scipy.io.savemat(w_path, {'weights': w})
+    scipy.io.savemat(b_path, {'biases': b})
+
+    # return the results from the function
+    return {'w': w, 'b': b, 'iterations': iterations, 'time': elapsed}
+
+
+def minibatches(X, Y, batch_size=256, shuffle=True, seed=595):
+    """Creates a source of mini-batches for train_streaming
+
+    Returns a function that takes an epoch number and yields the
+    (X_batch, Y_batch) pairs of that epoch. When shuffle is True, the
+    samples are visited in a different random order every epoch, but
+    the orders are reproducible since they are derived from seed.
+
+    X can be a numpy array or a FeatureStore. Only one batch of X is
+    converted to floating point at a time, so the full dataset never
+    has to fit in memory.
+    """
+
+    n = X.shape[0]
+
+    def batches(epoch):
+        order = np.arange(n)
+        if shuffle:
+            np.random.default_rng(seed + epoch).shuffle(order)
+
+        for start in range(0, n, batch_size):
+            # sorting the batch keeps reads from a memory-mapped
+            #   dataset close together on disk
+            idx = np.sort(order[start:start + batch_size])
+            X_batch = X[idx]
+
+            # FeatureStore subsets are scaled to floats on demand
+            if hasattr(X_batch, 'to_array'):
+                X_batch = X_batch.to_array()
+
+            yield X_batch, Y[idx]
+
+    return batches
+
+
+def train_streaming(batches, w_path, b_path, epochs=1, learning_rate=0.0005,
+                    optimizer='sgd', momentum=0.9, beta1=0.9, beta2=0.999,
+                    epsilon=1e-8, init=None, checkpoint_every=None, resume=False):
+    """Trains a logistic regression classifier one mini-batch at a time
+
+    batches is either a function that takes the epoch number and returns
+    an iterable of (X_batch, Y_batch) pairs (see minibatches()), or an
+    iterable of batches that can be looped over once per epoch. The data
+    only has to be in memory one batch at a time.
+
+    optimizer selects how each batch's gradient updates the parameters:
+        - 'sgd':      plain mini-batch gradient descent
+        - 'momentum': gradient descent with momentum
+        - 'adam':     the Adam optimizer
+
+    init gives starting parameters, in any form accepted by train().
+
+    checkpoint_every and resume work like in train(), counting mini-batches
+    instead of iterations; the snapshots also hold the optimizer's moment
+    estimates and the position in the epoch, and the loss curve records
+    the cost of the current batch. Since minibatches() derives each epoch's
+    order from its seed and the epoch number, a resumed run sees the same
+    batches the interrupted run would have. The batches of the interrupted
+    epoch that were already trained on are skipped (but still read). Only
+    a snapshot of train_streaming() with the same optimizer is resumed.
 
-    # initialize bias term
+    The optimized weight and bias terms are saved to their files and
+    returned from the function in a dictionary, just like train()
+    """
+
+    if optimizer not in ('sgd', 'momentum', 'adam'):
+        raise ValueError(f'Unknown optimizer: {optimizer}')
+
+    # the weights are created once the first batch shows the data's size
+    w = None
     b = 0
 
-    # hyperparameters
-    num_iterations = 15000
-    learning_rate = 0.0005
+    # optimizer state: first and second moment estimates
+    step = 0
+    vw, vb = 0, 0
+    sw, sb = 0, 0
+
+    # where to continue from: epoch number and batch within the epoch
+    first_epoch, skip = 0, 0
+    losses = []
+
+    prefix = checkpoint_prefix(w_path)
+    state = load_checkpoint(prefix) if resume else None
+    if state is not None:
+        check_checkpoint(state, kind='streaming', optimizer=optimizer)
+        w, b = initial_params({'w': state['w'], 'b': state['b']}, state['w'].size)
+        step = int(state['iteration'])
+        vw, vb, sw, sb = state['vw'], state['vb'], state['sw'], state['sb']
+        first_epoch, skip = int(state['epoch']), int(state['batch'])
+        losses = [tuple(row) for row in state['losses']]
+    elif checkpoint_every:
+        # old snapshots of another run must not be resumed later
+        clear_checkpoints(prefix)
 
     print('Training model....')
 
-    for i in tqdm(range(num_iterations)):
-        dw, db = propagate(w, b, X_train, y_train)
-
-        # gradient descent
-        w = w - (learning_rate * dw)
-        b = b - (learning_rate * db)
+    for epoch in tqdm(range(first_epoch, epochs)):
+        epoch_batches = batches(epoch) if callable(batches) else batches
+
+        for batch, (X_batch, Y_batch) in enumerate(epoch_batches):
+            if epoch == first_epoch and batch < skip:
+                continue
+
+            if w is None:
+                w, b = initial_params(init, X_batch.shape[1])
+
+            dw, db = propagate(w, b, X_batch, Y_batch)
+            step += 1
+
+            if optimizer == 'sgd':
+                w = w - (learning_rate * dw)
+                b = b - (learning_rate * db)
+
+            elif optimizer == 'momentum':
+                vw = momentum * vw + dw
+                vb = momentum * vb + db
+                w = w - (learning_rate * vw)
+                b = b - (learning_rate * vb)
+
+            else:
+                vw = beta1 * vw + (1 - beta1) * dw
+                vb = beta1 * vb + (1 - beta1) * db
+                sw = beta2 * sw + (1 - beta2) * dw ** 2
+                sb = beta2 * sb + (1 - beta2) * db ** 2
+
+                # bias-corrected moment estimates
+                vw_hat = vw / (1 - beta1 ** step)
+                vb_hat = vb / (1 - beta1 ** step)
+                sw_hat = sw / (1 - beta2 ** step)
+                sb_hat = sb / (1 - beta2 ** step)
+
+                w = w - learning_rate * vw_hat / (np.sqrt(sw_hat) + epsilon)
+                b = b - learning_rate * vb_hat / (np.sqrt(sb_hat) + epsilon)
+
+            if checkpoint_every and step % checkpoint_every == 0:
+                losses.append((step, cost(w, b, X_batch, Y_batch)))
+                save_checkpoint(prefix, step, {'kind': 'streaming',
+                                               'optimizer': optimizer,
+                                               'w': w, 'b': b,
+                                               'vw': vw, 'vb': vb,
+                                               'sw': sw, 'sb': sb,
+                                               'epoch': epoch,
+                                               'batch': batch + 1,
+                                               'losses': np.array(losses).reshape((-1, 2))})
+
+    if w is None:
+        raise ValueError('No training batches were provided.')
 
     # save the final weight and bias terms to their respective files
     scipy.io.savemat(w_path, {'weights': w})
     scipy.io.savemat(b_path, {'biases': b})
 
     # return the results from the function
-    return {'w': w, 'b': b}
\ No newline at end of file
+    return {'w': w, 'b': b}
+
+
+
+def train_incremental(init, X_new, y_new, X_old, y_old, w_path, b_path,
+                      replay_size=None, epochs=5, batch_size=64,
+                      learning_rate=0.001, optimizer='adam', seed=595):
+    """Updates a trained model with newly added images
+
+    Instead of retraining on the whole dataset, the model given as init
+    (a model.Model or a dictionary with 'w' and 'b') is trained for a few
+    epochs of train_streaming() on the new images (X_new, y_new) plus a
+    random "replay" sample of replay_size of the old images (X_old, y_old),
+    by default 4 times as many as there are new images. The replay sample
+    keeps the model from forgetting what it learned from the old data.
+
+    X_new and X_old are FeatureStores or arrays of values in [0, 1]. If the
+    model has a preprocessor, it is applied to both and saved next to the
+    new weights.
+
+    Returns the updated weight and bias terms in a dictionary, like train()
+    """
+
+    n_old = X_old.shape[0]
+    replay_size = min(n_old, replay_size or 4 * X_new.shape[0])
+
+    rng = np.random.default_rng(seed)
+    replay = np.sort(rng.choice(n_old, size=replay_size, replace=False))
+
+    X = np.concatenate([float_rows(X_new), float_rows(X_old[replay])])
+    Y = np.concatenate([np.asarray(y_new).reshape((-1, 1)),
+                        np.asarray(y_old).reshape((-1, 1))[replay]])
+
+    preprocessor = getattr(init, 'preprocessor', None)
+    if preprocessor is not None:
+        X = preprocessor.transform_rows(X)
+        preprocessor.save(preprocessor_path(w_path))
+
+    print(f'Updating model with {X_new.shape[0]} new and {replay_size} replayed images')
+
+    return train_streaming(minibatches(X, Y, batch_size, seed=seed), w_path, b_path,
+                           epochs=epochs, learning_rate=learning_rate,
+                           optimizer=optimizer, init=init)
+
+
+def softmax(z):
+    """Returns a probability distribution over the columns of each row of z
+
+    The largest value of each row is subtracted before exponentiating,
+    which leaves the result unchanged but keeps np.exp from overflowing.
+    """
+    e = np.exp(z - np.max(z, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
+
+
+def propagate_multiclass(W, b, X, Y):
+    """Implement the softmax cost function's gradient for K identities
+
+    Arguments:
+    W: weights - numpy array of size (num_px * num_px * 3, K)
+    b: biases - numpy array of size (1, K)
+    X: data of size (num. samples, num_px * num_px * 3)
+    Y: one-hot "label" matrix of size (num. samples, K)
+
+    Return:
+    dW: gradient of loss function w.r.t. W - same shape as W
+    db: gradient of loss function w.r.t. b - same shape as b
+    """
+
+    m = X.shape[0]
+
+    # Forward propagation: one matrix product scores every identity
+    A = softmax(X.dot(W) + b)
+
+    # Backward propagation (to find gradient)
+    dZ = A - Y
+    dW = (X.T.dot(dZ)) / m
+    db = (np.sum(dZ, axis=0, keepdims=True)) / m
+
+    return dW, db
+
+
+def train_multiclass(X_train, names, params_path, num_iterations=15000,
+                     learning_rate=0.0005, tol=1e-5):
+    """Trains a softmax classifier that recognizes every identity in names
+
+    names holds the person's name for each row of X_train. Instead of
+    training one (dim, 1) weight vector per person, a single (dim, K)
+    weight matrix is trained for all K distinct names at once, so each
+    gradient descent step is one matrix product instead of K.
+
+    The weights, biases and the list of identities are saved together
+    in the file at params_path and returned from the function in a
+    dictionary
+    """
+
+    # map each name to the column of its identity
+    identities, labels = np.unique(np.asarray(names), return_inverse=True)
+    K = len(identities)
+
+    # one-hot encode the labels
+    Y = np.zeros((len(labels), K))
+    Y[np.arange(len(labels)), labels] = 1
+
+    # num. dims (cols) for each sample
+    dim = X_train.shape[1]
+
+    # initialize weights and biases
+    W = np.zeros((dim, K))
+    b = np.zeros((1, K))
+
+    print(f'Training model for {K} identities....')
+    t1 = time.time()
+
+    iterations = 0
+    for i in tqdm(range(num_iterations)):
+        dW, db = propagate_multiclass(W, b, X_train, Y)
+        iterations += 1
+
+        # stop early once the gradient has (nearly) vanished
+        if tol and np.sqrt(np.sum(dW ** 2) + np.sum(db ** 2)) < tol:
+            break
+
+        # gradient descent
+        W = W - (learning_rate * dW)
+        b = b - (learning_rate * db)
+
+    elapsed = time.time() - t1
+    print(f'Finished {iterations} iterations in {elapsed:.2f} seconds')
+
+    # save every identity's parameters to the same file
+    scipy.io.savemat(params_path, {'weights': W,
+                                   'biases': b,
+                                   'identities': list(identities)})
+
+    return {'W': W, 'b': b, 'identities': list(identities),
+            'iterations': iterations, 'time': elapsed}
+
+
+def multiclass_classification(images, params_path, k=3):
+    """Finds the k most likely identities for one or more face images
+
+    params_path is a file written by train_multiclass(). images is either
+    a single image of shape (height, width, 3) or a stack of images of
+    shape (num. images, height, width, 3).
+
+    The parameters are only read from the file the first time a path is
+    used (or after the file changes), see model.MulticlassModel.
+
+    Returns a dictionary with the names of the top k identities for each
+    image and their probabilities, both ordered from most to least likely
+    and of shape (num. images, k)
+    """
+
+    # obtain the model for the file, loading it if necessary
+    model = _models.get(params_path)
+    if model is None:
+        model = _models[params_path] = MulticlassModel(params_path)
+    else:
+        model.reload_if_changed()
+
+    return model.top_k(images, k)
@@ -0,0 +1,381 @@
+import os
+import time
+import numpy as np
+import scipy.io
+import scipy.special
+from preprocessing import Preprocessor, preprocessor_path
+from feature_store import float_rows
+import artifact
+from instrumentation import timer, count
+
+# number of images scored at a time by the batch inference methods
+CHUNK_SIZE = 256
+
+
+class Model:
+    """A trained logistic regression classifier held in memory
+
+    Loads the weight and bias terms saved by logistic_regression.train()
+    once, as contiguous float32 arrays, so that predictions don't have to
+    read and parse the .mat files every time. If the files are replaced
+    (e.g. the model is retrained), reload_if_changed() picks up the new
+    parameters; with auto_reload = True this is checked on every call.
+    If the model was trained with a preprocessing.Preprocessor, it is
+    loaded from next to the weights and applied to every image.
+
+    Instead of the two .mat files, the model can be loaded from a single
+    artifact file written by save_artifact() (see artifact.py) by passing
+    artifact_path. The artifact is memory-mapped, and it also records the
+    input shape, identities, decision threshold and how the model was
+    trained (see the metadata attribute). If input_shape is given, the
+    model refuses to load parameters made for images of another shape.
+
+    predict_proba() and predict() accept a single image of shape
+    (height, width, 3) or a batch of shape (num. images, height, width, 3)
+    and return one row per image. For large archives of images, use
+    iter_predict_proba() or predict_proba_batch(), which score a fixed
+    number of images at a time so memory use stays bounded.
+    """
+
+    def __init__(self, w_path=None, b_path=None, threshold=None,
+                 auto_reload=False, artifact_path=None, input_shape=None):
+        if artifact_path is None and (w_path is None or b_path is None):
+            raise ValueError('Either w_path and b_path or artifact_path is required.')
+
+        self.w_path = w_path
+        self.b_path = b_path
+        self.artifact_path = artifact_path
+        self.input_shape = None if input_shape is None else tuple(input_shape)
+        self.threshold_override = threshold
+        self.auto_reload = auto_reload
+        self.load()
+
+    def _paths(self):
+        """Returns the files the parameters are loaded from"""
+        if self.artifact_path is not None:
+            return [self.artifact_path]
+        return [self.w_path, self.b_path, preprocessor_path(self.w_path)]
+
+    def _mtimes(self):
+        return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None
+                     for path in self._paths())
+
+    def load(self):
+        """Reads the weight and bias terms from their files"""
+
+        # record the modification times first so that a file written
+        #   while loading is picked up again by the next reload check
+        self.mtimes = self._mtimes()
+
+        if self.artifact_path is not None:
+            self._load_artifact()
+        else:
+            self._load_mat()
+
+        self.threshold = self.threshold_override
+        if self.threshold is None:
+            self.threshold = self.metadata.get('threshold', 0.5)
+
+        # number of values in one input image
+        if self.preprocessor is not None:
+            self.dim = self.preprocessor.input_dim
+        else:
+            self.dim = self.w.shape[0]
+
+        self._validate()
+
+    def _load_mat(self):
+        with timer('model.loadmat'):
+            w = scipy.io.loadmat(self.w_path)['weights']
+            b = scipy.io.loadmat(self.b_path)['biases']
+
+        self.w = np.ascontiguousarray(w, dtype=np.float32)
+        self.b = np.float32(np.ravel(b)[0])
+        self.metadata = {}
+
+        # the preprocessor the model was trained with, if any
+        pre_path = preprocessor_path(self.w_path)
+        self.preprocessor = Preprocessor.load(pre_path) if os.path.exists(pre_path) else None
+
+    def _load_artifact(self):
+        with timer('model.load_artifact'):
+            arrays, self.metadata = artifact.load_artifact(self.artifact_path)
+
+        if self.metadata.get('format') != 'faceid-model':
+            raise ValueError(f'{self.artifact_path} is not a face ID model.')
+
+        # int8 weights are expanded once; float32 weights stay memory-mapped
+        if 'weights_int8' in arrays:
+            self.w = artifact.dequantize_int8(arrays['weights_int8'], arrays['weight_scale'])
+        else:
+            self.w = arrays['weights']
+        self.b = np.float32(arrays['bias'][0])
+
+        config = self.metadata.get('preprocessor')
+        self.preprocessor = None
+        if config is not None:
+            self.preprocessor = Preprocessor.from_config(config,
+                                                         arrays.get('pre_mean'),
+                                                         arrays.get('pre_components'))
+
+    def _validate(self):
+        """Checks that the parameters fit the expected input images"""
+        shape = self.metadata.get('input_shape')
+        if shape is not None and self.input_shape is not None \
+                and tuple(shape) != self.input_shape:
+            raise ValueError(f'The model expects images of shape {tuple(shape)}, '
+                             f'not {self.input_shape}')
+
+        if self.input_shape is not None and np.prod(self.input_shape) != self.dim:
+            raise ValueError(f'The model expects images with {self.dim} values, '
+                             f'not images of shape {self.input_shape}')
+
+        # the weights have to match the features the images turn into
+        features = self.dim
+        if self.preprocessor is not None:
+            features = self.preprocessor.transform_rows(
+                np.zeros((1, self.dim), dtype=np.float32)).shape[1]
+        if features != self.w.shape[0]:
+            raise ValueError(f'The weights have {self.w.shape[0]} rows but the '
+                             f'images have {features} features')
+
+    def save_artifact(self, path, input_shape=None, identities=None, threshold=None,
+                      hyperparameters=None, data_hash=None, quantize=False,
+                      evaluation=None):
+        """Saves the model to a single artifact file
+
+        input_shape is the (height, width, channels) of the images the model
+        expects; it defaults to the preprocessor's input shape. With
+        quantize = True the weights are stored as int8 with a float32 scale,
+        which makes the file about 4x smaller. evaluation is a summary of an
+        evaluation.evaluate() report of the model.
+        """
+        if input_shape is None:
+            if self.preprocessor is not None:
+                input_shape = self.preprocessor.input_shape
+            else:
+                input_shape = self.metadata.get('input_shape', self.input_shape)
+        if input_shape is None or np.prod(input_shape) != self.dim:
+            raise ValueError(f'input_shape has to describe images with {self.dim} values')
+
+        arrays = {'bias': np.array([self.b], dtype=np.float32)}
+        if quantize:
+            arrays['weights_int8'], arrays['weight_scale'] = artifact.quantize_int8(self.w)
+        else:
+            arrays['weights'] = np.asarray(self.w, dtype=np.float32)
+
+        if self.preprocessor is not None and self.preprocessor.components is not None:
+            arrays['pre_mean'] = self.preprocessor.mean
+            arrays['pre_components'] = self.preprocessor.components
+
+        metadata = {'format': 'faceid-model',
+                    'input_shape': [int(v) for v in input_shape],
+                    'identities': list(identities or self.metadata.get('identities', [])),
+                    'threshold': float(threshold if threshold is not None else self.threshold),
+                    'weights': 'int8' if quantize else 'float32',
+                    'hyperparameters': hyperparameters or self.metadata.get('hyperparameters', {}),
+                    'data_hash': data_hash or self.metadata.get('data_hash'),
+                    'evaluation': evaluation or self.metadata.get('evaluation'),
+                    'preprocessor': None if self.preprocessor is None else self.preprocessor.config(),
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+        artifact.save_artifact(path, arrays, metadata)
+
+    def reload_if_changed(self):
+        """Reloads the parameters if either file changed on disk
+
+        Returns True if the parameters were reloaded
+        """
+        if self._mtimes() == self.mtimes:
+            return False
+
+        self.load()
+        return True
+
+    def _features(self, images):
+        """Flattens one image or a batch of images into float32 rows in [0, 1]"""
+        return float_rows(images, self.dim, scale=1 / 255)
+
+    def _score_rows(self, X):
+        """Returns the probabilities of float32 rows of pixels in [0, 1]"""
+        count('model.images_scored', X.shape[0])
+        with timer('model.score'):
+            if self.preprocessor is not None:
+                X = self.preprocessor.transform_rows(X)
+
+            return scipy.special.expit(np.dot(X, self.w) + self.b)
+
+    def predict_proba(self, images):
+        """Returns the probability that each image shows the target person
+
+        images can also be a FeatureStore, which is scored chunk by chunk
+        """
+        if self.auto_reload:
+            self.reload_if_changed()
+
+        if hasattr(images, 'chunks'):
+            probs = np.empty((images.shape[0], 1), dtype=np.float32)
+            for start, stop, chunk in images.chunks():
+                probs[start:stop] = self._score_rows(chunk)
+            return probs
+
+        return self._score_rows(self._features(images))
+
+    def predict(self, images, threshold=None):
+        """Returns the label (1.0 or 0.0) assigned to each image"""
+        if threshold is None:
+            threshold = self.threshold
+
+        return (self.predict_proba(images) >= threshold) * 1.0
+
+    def _image_chunks(self, images, chunk_size):
+        """Yields uint8 blocks of at most chunk_size flattened images
+
+        Slices of an array are yielded directly. Images from any other
+        iterable are copied into a reused staging buffer first.
+        """
+        if isinstance(images, np.ndarray):
+            images = images.reshape((images.shape[0], -1))
+            for start in range(0, images.shape[0], chunk_size):
+                yield images[start:start + chunk_size]
+            return
+
+        stage = np.empty((chunk_size, self.dim), dtype=np.uint8)
+        k = 0
+        for image in images:
+            stage[k] = np.ravel(image)
+            k += 1
+
+            if k == chunk_size:
+                yield stage
+                k = 0
+
+        if k:
+            yield stage[:k]
+
+    def iter_predict_proba(self, images, chunk_size=CHUNK_SIZE):
+        """Scores a stream of images chunk_size images at a time
+
+        images is a uint8 array of shape (num. images, height, width, 3)
+        or any iterable of images, e.g. a generator reading them from an
+        archive. The images are converted to float32 in a preallocated
+        buffer, and for each chunk (start, probs) is yielded, where probs
+        holds the probabilities of images start:start + len(probs).
+
+        probs is a view into a buffer that is reused by the next chunk,
+        so copy it if it has to be kept.
+        """
+        if self.auto_reload:
+            self.reload_if_changed()
+
+        buf = np.empty((chunk_size, self.dim), dtype=np.float32)
+        out = np.empty((chunk_size, 1), dtype=np.float32)
+        scale = np.float32(1 / 255)
+
+        start = 0
+        for chunk in self._image_chunks(images, chunk_size):
+            k = chunk.shape[0]
+
+            if chunk.shape[1] != self.dim:
+                raise ValueError(f'Expected images with {self.dim} values, '
+                                 f'got {chunk.shape[1]}')
+
+            count('model.images_scored', k)
+            with timer('model.score'):
+                X = np.multiply(chunk, scale, out=buf[:k])
+                if self.preprocessor is not None:
+                    X = self.preprocessor.transform_rows(X)
+
+                z = np.dot(X, self.w, out=out[:k])
+                z += self.b
+                scipy.special.expit(z, out=z)
+
+            yield start, z
+            start += k
+
+    def predict_proba_batch(self, images, chunk_size=CHUNK_SIZE):
+        """Returns the probabilities of many images, scored in chunks
+
+        Works like predict_proba(), but never converts more than
+        chunk_size images to floating point at once.
+        """
+        if hasattr(images, '__len__'):
+            # the number of images is known, so fill a preallocated array
+            probs = np.empty((len(images), 1), dtype=np.float32)
+            for start, z in self.iter_predict_proba(images, chunk_size):
+                probs[start:start + len(z)] = z
+            return probs
+
+        chunks = [z.copy() for _, z in self.iter_predict_proba(images, chunk_size)]
+        if not chunks:
+            return np.empty((0, 1), dtype=np.float32)
+        return np.concatenate(chunks)
+
+
+class MulticlassModel:
+    """A trained softmax classifier over several identities held in memory
+
+    The multiclass counterpart of Model: the weights, biases and
+    identities saved by logistic_regression.train_multiclass() are read
+    from params_path once, as contiguous float32 arrays, instead of on
+    every call. reload_if_changed() (or auto_reload = True) picks up a
+    retrained file.
+    """
+
+    def __init__(self, params_path, auto_reload=False):
+        self.params_path = params_path
+        self.auto_reload = auto_reload
+        self.load()
+
+    def load(self):
+        """Reads the parameters and identities from params_path"""
+        self.mtime = os.stat(self.params_path).st_mtime_ns
+
+        with timer('model.loadmat'):
+            params = scipy.io.loadmat(self.params_path)
+
+        self.W = np.ascontiguousarray(params['weights'], dtype=np.float32)
+        self.b = np.ascontiguousarray(params['biases'], dtype=np.float32).reshape((1, -1))
+        self.identities = np.array([str(name).strip() for name in params['identities']])
+        self.dim = self.W.shape[0]
+
+    def reload_if_changed(self):
+        """Reloads the parameters if the file changed on disk
+
+        Returns True if the parameters were reloaded
+        """
+        if os.stat(self.params_path).st_mtime_ns == self.mtime:
+            return False
+
+        self.load()
+        return True
+
+    def predict_proba(self, images):
+        """Returns the probability of every identity for each image
+
+        images is a single image or a batch of images. Returns an array of
+        shape (num. images, num. identities)
+        """
+        if self.auto_reload:
+            self.reload_if_changed()
+
+        X = float_rows(images, self.dim, scale=1 / 255)
+        count('model.images_scored', X.shape[0])
+        with timer('model.score'):
+            return scipy.special.softmax(np.dot(X, self.W) + self.b, axis=1)
+
+    def top_k(self, images, k=3):
+        """Finds the k most likely identities for each image
+
+        Returns a dictionary with the names of the top k identities for each
+        image and their probabilities, both ordered from most to least likely
+        and of shape (num. images, k)
+        """
+        A = self.predict_proba(images)
+
+        # columns of the k largest probabilities, most likely first
+        k = min(k, A.shape[1])
+        top = np.argsort(-A, axis=1)[:, :k]
+
+        return {'identities': self.identities[top],
+                'probs': np.take_along_axis(A, top, axis=1)}
@@ -1,9 +1,13 @@
 import cv2         
 import time        
+import threading
+import numpy as np
 from PIL import Image 
 import re 
+from instrumentation import timer, timed, count
+from detection import FaceTracker, crop_face
 
-def capture_image(box_size=None):
+def capture_image(box_size=None, save=True):
     """Captures a frame from the device's live webcam feed
 
     Uses the cv2 library to access the device's webcam and capture one frame 
@@ -14,6 +18,10 @@ def capture_image(box_size=None):
     dimensions will be drawn in the capture window. If box_size = None (default), 
     there will be no box.
 
+    If save = False, the frame is not written to disk. Instead it is returned
+    in the result under the key 'frame', so it can be cropped and resized in
+    memory with crop_array() and resize_array().
+
     The function returns:
         - 0 if an error occurred 
         - 1 if the operation succeeded but no box_size was specified
@@ -51,6 +59,9 @@ def capture_image(box_size=None):
                 flag = False
                 break
 
+            # draw on a copy so the captured frame doesn't contain the box
+            display = frame.copy()
+
             if box_size:
                 # draw a box on the window to show the user where to put their head
                 box_color = (255, 255, 255)
@@ -60,20 +71,21 @@ def capture_image(box_size=None):
                 x, y = (int((frame.shape[1] - box_size[0]) / 2),
                         int((frame.shape[0] - box_size[1]) / 2))
 
-                cv2.rectangle(frame,
+                cv2.rectangle(display,
                             (x, y),                               # start coordinates
                             (x + box_size[0], y + box_size[1]),   # end coordinates
                             box_color,
                             box_thickness)
             
             # flip the camera feed and display it on the screen
-            cv2.imshow('Face Recognition', cv2.flip(frame, 1))
+            cv2.imshow('Face Recognition', cv2.flip(display, 1))
 
             # once 5 seconds have passed, capture the user's image
             # and save it to the system
             if time.time() - t1 > 5:
                 cap.release()
-                cv2.imwrite('captures/capture.jpg', frame)
+                if save:
+                    cv2.imwrite('captures/capture.jpg', frame)
                 flag = True 
                 break 
 
@@ -93,15 +105,45 @@ def capture_image(box_size=None):
     #   if there was a box -> return the start coordinates, height, and 
     #     width of the box in case the image needs to be cropped later
     #   if there was no box -> return 1 to show the image was saved
+    #   if the frame wasn't saved -> the result also holds the frame
     if not flag:
         return None 
-    else:
-        return {'x': x, 
-                'y': y, 
-                'width': box_size[0], 
-                'height': box_size[1]} if box_size else 1
+
+    result = {'x': x, 
+              'y': y, 
+              'width': box_size[0], 
+              'height': box_size[1]} if box_size else {}
+
+    if not save:
+        result['frame'] = frame
+        return result
+
+    return result if box_size else 1
     
 
+def crop_array(image, x=0, y=0, width=0, height=0):
+    """Crops an image that is already in memory
+
+    image is a numpy array such as a frame from the camera. The cropped
+    image is a view into image rather than a copy, so this takes no time
+    regardless of the size of the image.
+
+    x, y: the coordinates of the top-left corner of the cropping rectangle
+    width, height: dimensions of the cropping rectangle
+    """
+    return image[y:y + height, x:x + width]
+
+
+@timed('capture.resize')
+def resize_array(image, width=0, height=0, interpolation=cv2.INTER_LANCZOS4):
+    """Resizes an image that is already in memory
+
+    Returns a new numpy array with the given width and height. Lanczos
+    interpolation is used by default to match resize_image().
+    """
+    return cv2.resize(image, (width, height), interpolation=interpolation)
+
+
 def crop_image(file_path=None, x=0,  y=0, width=0, height=0):
     """Crops an image to a specific size and saves it as a new file
 
@@ -113,6 +155,8 @@ def crop_image(file_path=None, x=0,  y=0, width=0, height=0):
 
     x, y: the coordinates of the top-left corner of the cropping rectangle
     width, height: dimensions of the cropping rectangle
+
+    To crop an image without writing it to disk, use crop_array()
     """
     if not file_path:
         print("File path not provided.")
@@ -124,14 +168,14 @@ def crop_image(file_path=None, x=0,  y=0, width=0, height=0):
         name = re.findall(name_pattern, file_path)[0]
 
         # open the image
-        im = Image.open(file_path) 
+        im = np.asarray(Image.open(file_path))
 
         # crop the image
-        im_c = im.crop((x, y, x + width, y + height))
+        im_c = crop_array(im, x, y, width, height)
 
         # save the adjusted image to the system and return its path
         output_path = f'captures/cropped_{name}.jpg'
-        im_c.save(output_path)
+        Image.fromarray(im_c).save(output_path)
         return output_path
 
     except Exception as e:
@@ -149,6 +193,8 @@ def resize_image(file_path=None, output_path=None, width=0, height=0):
     under the name "resized_[file_path]"
 
     The path to the resized image is returned from the function
+
+    To resize an image without writing it to disk, use resize_array()
     """
     
     if not file_path:
@@ -156,25 +202,246 @@ def resize_image(file_path=None, output_path=None, width=0, height=0):
         return 
 
     try:
-        # extract the 'name' of file "name.jpg"
-        # name_pattern = re.compile('/(.+)\.')
-        # name = re.findall(name_pattern, file_path)[0]
-
         # open the image
-        im = Image.open(file_path)
+        im = np.asarray(Image.open(file_path))
 
         # resize the image
-        im_r = im.resize((width, height), Image.LANCZOS)
+        im_r = resize_array(im, width, height)
 
         # save the resized image and return its path
-        
-        im_r.save(output_path)
+        Image.fromarray(im_r).save(output_path)
         return output_path 
 
     except Exception as e:
         print(f'Error with resizing {file_path}')
         print(e)
 
+
+class _IterableSource:
+    """Wraps an iterable of frames so it can be read like cv2.VideoCapture"""
+
+    def __init__(self, frames):
+        self.frames = iter(frames)
+
+    def read(self):
+        frame = next(self.frames, None)
+        return frame is not None, frame
+
+    def release(self):
+        pass
+
+
+class FrameGrabber:
+    """Reads frames from a video source on a background thread
+
+    source can be a camera index or video file path (opened with
+    cv2.VideoCapture), any object with a cv2.VideoCapture-style read()
+    method, or an iterable of frames, which makes it easy to test with
+    recorded or synthetic frames.
+
+    Only the newest frame is kept. With drop_frames = True, frames that
+    arrive faster than they are processed replace the older ones, so
+    read() never returns a stale frame, which is what a live camera
+    needs. With drop_frames = False, the background thread waits until
+    each frame has been read before grabbing the next one, so every frame
+    of a video file or list of frames is processed. By default, frames
+    are only dropped for camera indices.
+    """
+
+    def __init__(self, source=0, drop_frames=None):
+        self.owns_source = isinstance(source, (int, str))
+        self.drop_frames = isinstance(source, int) if drop_frames is None else drop_frames
+
+        if self.owns_source:
+            self.source = cv2.VideoCapture(source)
+        elif hasattr(source, 'read'):
+            self.source = source
+        else:
+            self.source = _IterableSource(source)
+
+        self.frame = None
+        self.count = 0       # number of frames grabbed so far
+        self.seen = 0        # number of the last frame returned by read()
+        self.done = False
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Starts grabbing frames, returns None if the source can't be opened"""
+        if hasattr(self.source, 'isOpened') and not self.source.isOpened():
+            print('Error: Could not open video source.')
+            return None
+
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped:
+            with timer('capture.grab'):
+                ret, frame = self.source.read()
+
+            with self.condition:
+                if not ret:
+                    self.done = True
+                    self.condition.notify_all()
+                    return
+
+                # wait for the previous frame to be read instead of
+                #   replacing it
+                if not self.drop_frames:
+                    self.condition.wait_for(lambda: self.count == self.seen or self.stopped)
+                    if self.stopped:
+                        return
+
+                # the previous frame was never read, so it is dropped
+                if self.count > self.seen:
+                    count('capture.frames_dropped')
+                count('capture.frames_grabbed')
+
+                self.frame = frame
+                self.count += 1
+                self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """Waits for a frame newer than the last one returned
+
+        Returns None once the source has no more frames or if no new
+        frame arrived within timeout seconds
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.count > self.seen or self.done,
+                                    timeout)
+
+            if self.count > self.seen:
+                self.seen = self.count
+                # lets the background thread grab the next frame
+                self.condition.notify_all()
+                return self.frame
+
+            return None
+
+    def stop(self):
+        """Stops the background thread and releases the source if we opened it"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        if self.owns_source:
+            self.source.release()
+
+
+def recognize_stream(model, source=0, box_size=(250, 250), size=(100, 100),
+                     threshold=0.7, required_frames=5, timeout=None, show=True,
+                     detect=False):
+    """Continuously checks the faces in a video feed until one is recognized
+
+    Frames are grabbed from source by a FrameGrabber on a background
+    thread while the current frame is being scored. For every frame, the
+    box in the center of the frame is cropped (in memory), resized to
+    size and passed to model.predict_proba(), e.g. a model.Model.
+
+    With detect = True, the face is found and tracked with a
+    detection.FaceTracker instead of assuming it is inside the box, and
+    its aligned crop is classified. Frames without a face are not
+    classified at all (and break the streak of recognized frames). The
+    model should then be trained on faces detected the same way, see
+    load_images.load_dataset(detect=True).
+
+    As soon as required_frames consecutive frames have a probability of
+    at least threshold, the face counts as recognized. The function also
+    returns once timeout seconds have passed, the source runs out of
+    frames, or 'q' / 'ESC' is pressed in the camera window (when show is
+    True).
+
+    The function returns a dictionary with:
+        - recognized: whether the face was recognized
+        - frames: how many frames were scored
+        - prob: the probability of the last frame scored
+    """
+
+    grabber = FrameGrabber(source).start()
+    if grabber is None:
+        return None
+
+    tracker = FaceTracker() if detect else None
+
+    t1 = time.time()
+    frames = 0
+    streak = 0
+    prob = None
+    recognized = False
+
+    try:
+        while True:
+            remaining = None if timeout is None else timeout - (time.time() - t1)
+            if remaining is not None and remaining <= 0:
+                break
+
+            frame = grabber.read(timeout=remaining)
+            if frame is None:
+                break
+
+            if tracker is not None:
+                box = tracker.update(frame)
+            else:
+                # specify the coordinates of the top left corner of the box
+                box = (int((frame.shape[1] - box_size[0]) / 2),
+                       int((frame.shape[0] - box_size[1]) / 2),
+                       box_size[0], box_size[1])
+
+            if box is None:
+                # no face in the frame, so there is nothing to classify
+                count('capture.frames_without_face')
+                streak = 0
+            else:
+                x, y, width, height = box
+
+                # crop the box out of the frame and resize it to the
+                #   size of the training images
+                if tracker is not None:
+                    face = crop_face(frame, box, size)
+                else:
+                    face = crop_array(frame, x, y, width, height)
+                    face = resize_array(face, size[0], size[1])
+
+                prob = float(np.ravel(model.predict_proba(face))[0])
+                frames += 1
+
+                # count how many frames in a row passed the threshold
+                streak = streak + 1 if prob >= threshold else 0
+                if streak >= required_frames:
+                    recognized = True
+                    break
+
+            if show:
+                # draw the box on a copy so the next crop isn't affected
+                display = frame.copy()
+                if box is not None:
+                    cv2.rectangle(display,
+                                  (x, y),
+                                  (x + width, y + height),
+                                  (255, 255, 255),
+                                  3)
+                cv2.imshow('Face Recognition', cv2.flip(display, 1))
+
+                # 'q' or 'ESC' can be used to escape from the program
+                if cv2.waitKey(1) in [ord('q'), 27]:
+                    print('Escaped program with "q" or "ESC"')
+                    break
+
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt. Exiting program....')
+
+    finally:
+        grabber.stop()
+        if show:
+            cv2.destroyWindow('Face Recognition')
+
+    return {'recognized': recognized, 'frames': frames, 'prob': prob}
+
 if __name__ == '__main__':
     # capture_image()
     # crop_image()
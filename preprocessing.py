@@ -0,0 +1,178 @@
+import os
+import numpy as np
+from enrollment import randomized_pca
+from feature_store import float_rows
+from atomic_file import atomic_write
+
+# number of rows transformed at a time
+CHUNK_SIZE = 1024
+
+# weights used by cv2.cvtColor to convert BGR pixels to grayscale
+GRAY_WEIGHTS = np.array([0.114, 0.587, 0.299], dtype=np.float32)
+
+
+def preprocessor_path(w_path):
+    """Returns where the preprocessor of the weights at w_path is saved
+
+    e.g. 'gd_results/training_weights3.mat' -->
+         'gd_results/training_weights3_preprocessing.npz'
+    """
+    return f'{os.path.splitext(w_path)[0]}_preprocessing.npz'
+
+
+class Preprocessor:
+    """Reduces images to a much smaller number of features before training
+
+    The stages are applied in this order, and each one is optional:
+        - grayscale:  combine the 3 color channels into 1 with the luma
+                      weights GRAY_WEIGHTS (3x fewer features)
+        - downsample: average blocks of downsample x downsample pixels
+                      (downsample^2 x fewer features)
+        - projection: project onto n_components directions, either the
+                      principal components of the training data ('pca')
+                      or random Gaussian directions ('random')
+
+    The input images have input_shape = (height, width, channels). fit()
+    only has to be called once (it's a no-op without a projection); the
+    preprocessor is then saved next to the model's weights so that train,
+    classification and testing.py all apply the exact same transform.
+    """
+
+    def __init__(self, input_shape, grayscale=False, downsample=1,
+                 projection=None, n_components=256, seed=595):
+        if projection not in (None, 'pca', 'random'):
+            raise ValueError(f'Unknown projection: {projection}')
+
+        self.input_shape = tuple(int(v) for v in input_shape)
+        self.grayscale = grayscale
+        self.downsample = downsample
+        self.projection = projection
+        self.n_components = n_components
+        self.seed = seed
+
+        # learned by fit() when there is a projection
+        self.mean = None
+        self.components = None
+
+    @property
+    def input_dim(self):
+        return int(np.prod(self.input_shape))
+
+    @property
+    def fitted(self):
+        return self.projection is None or self.components is not None
+
+    def _reduce(self, X):
+        """Applies the grayscale and downsample stages to float32 rows"""
+        h, w, c = self.input_shape
+        X = X.reshape((X.shape[0], h, w, c))
+
+        if self.grayscale and c == 3:
+            X = np.dot(X, GRAY_WEIGHTS)[..., np.newaxis]
+
+        f = self.downsample
+        if f > 1:
+            h, w = (h // f) * f, (w // f) * f
+            X = X[:, :h, :w]
+            X = X.reshape((X.shape[0], h // f, f, w // f, f, X.shape[-1])).mean(axis=(2, 4))
+
+        return X.reshape((X.shape[0], -1)).astype(np.float32, copy=False)
+
+    def fit(self, X, max_samples=2000):
+        """Learns the projection from the training data X
+
+        X is a FeatureStore or an array of rows of pixels in [0, 1], the
+        same input as transform_rows() and lr.train(). The principal
+        components are fit to at most max_samples randomly chosen rows,
+        which is plenty to find the main directions of variation of face
+        images.
+        """
+        if self.projection is None:
+            return self
+
+        n = X.shape[0]
+        rng = np.random.default_rng(self.seed)
+        rows = np.sort(rng.choice(n, size=min(n, max_samples), replace=False))
+        reduced = self._reduce(float_rows(X[rows]))
+
+        if self.projection == 'pca':
+            self.mean, self.components = randomized_pca(reduced, self.n_components,
+                                                        seed=self.seed)
+        else:
+            d = reduced.shape[1]
+            self.mean = np.zeros(d, dtype=np.float32)
+            self.components = (rng.standard_normal((self.n_components, d))
+                               / np.sqrt(self.n_components)).astype(np.float32)
+
+        return self
+
+    def transform_rows(self, X):
+        """Transforms float32 rows of pixels in [0, 1] into features"""
+        if not self.fitted:
+            raise ValueError('The preprocessor has to be fit before it is used.')
+
+        X = self._reduce(X)
+        if self.components is not None:
+            X = np.dot(X - self.mean, self.components.T)
+        return X
+
+    def transform(self, X):
+        """Transforms a FeatureStore, or uint8 images, into features
+
+        Returns a float32 array with one row per image
+        """
+        if hasattr(X, 'chunks'):
+            out = None
+            for start, stop, chunk in X.chunks(CHUNK_SIZE):
+                features = self.transform_rows(chunk)
+                if out is None:
+                    out = np.empty((X.shape[0], features.shape[1]), dtype=np.float32)
+                out[start:stop] = features
+            return out
+
+        X = np.asarray(X).reshape((-1, self.input_dim))
+        return self.transform_rows(float_rows(X, scale=1 / 255))
+
+    def config(self):
+        """Returns the settings of the preprocessor as a plain dictionary"""
+        return {'input_shape': list(self.input_shape),
+                'grayscale': bool(self.grayscale),
+                'downsample': int(self.downsample),
+                'projection': self.projection,
+                'n_components': int(self.n_components),
+                'seed': int(self.seed)}
+
+    @classmethod
+    def from_config(cls, config, mean=None, components=None):
+        """Creates a preprocessor from config() and its learned projection"""
+        pre = cls(**config)
+        pre.mean = mean
+        pre.components = components
+        return pre
+
+    def save(self, path):
+        """Saves the settings and the learned projection to a .npz file"""
+        arrays = {key: np.array('' if value is None else value)
+                  for key, value in self.config().items()}
+        if self.components is not None:
+            arrays['mean'] = self.mean
+            arrays['components'] = self.components
+
+        with atomic_write(path) as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a preprocessor written by save()"""
+        with np.load(path) as data:
+            config = {'input_shape': data['input_shape'].tolist(),
+                      'grayscale': bool(data['grayscale']),
+                      'downsample': int(data['downsample']),
+                      'projection': str(data['projection']) or None,
+                      'n_components': int(data['n_components']),
+                      'seed': int(data['seed'])}
+
+            if 'components' in data:
+                return cls.from_config(config, data['mean'], data['components'])
+
+        return cls.from_config(config)
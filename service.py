@@ -0,0 +1,345 @@
+import json
+import time
+import asyncio
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pic_ops import FrameGrabber, crop_array, resize_array
+from detection import FaceTracker, crop_face
+from model import Model
+from instrumentation import timer, count
+
+
+class BatchScorer:
+    """Scores faces from many cameras together in micro-batches
+
+    Cameras call score() with one face at a time. Faces that arrive
+    within max_delay seconds of each other (up to max_batch of them) are
+    stacked and scored with a single model.predict_proba() call on a
+    thread pool of workers threads, so the cost of the matrix product
+    is shared by all the cameras instead of paid once per frame.
+
+    At most queue_size faces wait to be scored. When the queue is full,
+    score() drops the face and returns None right away, since by the
+    time it could be scored the camera has newer frames anyway.
+    """
+
+    def __init__(self, model, max_batch=32, max_delay=0.005, workers=2, queue_size=64):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        return self
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    async def score(self, face):
+        """Returns the probability of one face, or None if it was dropped"""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((face, future))
+        except asyncio.QueueFull:
+            count('service.faces_dropped')
+            return None
+        return await future
+
+    async def _next_batch(self):
+        """Waits for a face, then collects more for up to max_delay seconds"""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+
+        while len(batch) < self.max_batch:
+            # take whatever is already waiting without sleeping
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._next_batch()
+            faces = np.stack([face for face, _ in batch])
+            count('service.batches')
+            count('service.faces_scored', len(batch))
+
+            try:
+                with timer('service.score_batch'):
+                    probs = await loop.run_in_executor(self.executor,
+                                                       self.model.predict_proba, faces)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), prob in zip(batch, np.ravel(probs)):
+                if not future.done():
+                    future.set_result(float(prob))
+
+
+class Camera:
+    """Recognizes faces in one video source, e.g. the camera at one door
+
+    Frames are grabbed by a FrameGrabber. For live cameras it only keeps
+    the newest frame, so frames that arrive while a face is being scored
+    are dropped instead of queueing up; video files and lists of frames
+    are processed frame by frame (see FrameGrabber's drop_frames). The
+    box in the center of every frame is cropped, resized to size and
+    scored by the shared BatchScorer, just like in
+    pic_ops.recognize_stream(): once required_frames frames in a row
+    reach threshold, a 'recognized' event is recorded.
+
+    With detect = True, the face is tracked with a detection.FaceTracker
+    instead, and frames without a face are never sent to the scorer.
+    """
+
+    def __init__(self, name, source, scorer, threshold=0.7, required_frames=5,
+                 box_size=(250, 250), size=(100, 100), max_events=100, detect=False,
+                 drop_frames=None):
+        self.name = name
+        self.source = source
+        self.drop_frames = drop_frames
+        self.scorer = scorer
+        self.threshold = threshold
+        self.required_frames = required_frames
+        self.box_size = box_size
+        self.size = size
+        self.tracker = FaceTracker() if detect else None
+
+        self.state = 'starting'
+        self.error = None
+        self.frames = 0
+        self.streak = 0
+        self.prob = None
+        self.events = collections.deque(maxlen=max_events)
+
+    def _face(self, frame):
+        """Returns the crop of the face in frame to classify, or None"""
+        if self.tracker is not None:
+            box = self.tracker.update(frame)
+            return None if box is None else crop_face(frame, box, self.size)
+
+        x = int((frame.shape[1] - self.box_size[0]) / 2)
+        y = int((frame.shape[0] - self.box_size[1]) / 2)
+        face = crop_array(frame, x, y, self.box_size[0], self.box_size[1])
+        return resize_array(face, self.size[0], self.size[1])
+
+    def _update(self, prob):
+        self.frames += 1
+        self.prob = prob
+
+        # count how many frames in a row passed the threshold
+        self.streak = self.streak + 1 if prob >= self.threshold else 0
+        if self.streak >= self.required_frames:
+            self.events.append({'camera': self.name,
+                                'recognized': True,
+                                'prob': prob,
+                                'time': time.time()})
+            count('service.recognized')
+            self.streak = 0
+
+    async def run(self):
+        """Processes frames until the source runs out or the task is cancelled
+
+        An error while processing a frame stops only this camera: its state
+        becomes 'error' and the exception is kept in error for status().
+        """
+        loop = asyncio.get_running_loop()
+
+        grabber = FrameGrabber(self.source, self.drop_frames).start()
+        if grabber is None:
+            self.state = 'error'
+            return
+
+        self.state = 'running'
+        try:
+            while True:
+                # wait for a new frame without blocking the event loop
+                frame = await loop.run_in_executor(None, grabber.read, 1.0)
+                if frame is None:
+                    if grabber.done:
+                        break
+                    continue
+
+                # the crop (and with detect = True, the Haar cascade) runs
+                #   on a thread so the other cameras and the HTTP API
+                #   aren't blocked meanwhile
+                face = await loop.run_in_executor(None, self._face, frame)
+                if face is None:
+                    # no face in the frame, so nothing to score
+                    count('service.frames_without_face')
+                    self.streak = 0
+                    continue
+
+                prob = await self.scorer.score(face)
+                if prob is not None:
+                    self._update(prob)
+        except Exception as e:
+            # a failing camera (or a model error while scoring its face)
+            #   must not take the other cameras and the HTTP API down
+            self.state = 'error'
+            self.error = f'{type(e).__name__}: {e}'
+            count('service.camera_errors')
+            print(f'Camera {self.name} stopped: {self.error}')
+        finally:
+            await loop.run_in_executor(None, grabber.stop)
+            if self.state != 'error':
+                self.state = 'stopped'
+
+    def status(self):
+        return {'state': self.state,
+                'error': self.error,
+                'frames': self.frames,
+                'prob': self.prob,
+                'streak': self.streak,
+                'recognitions': len(self.events),
+                'last_recognized': self.events[-1]['time'] if self.events else None}
+
+
+class Service:
+    """Runs several cameras with one model and serves their decisions
+
+    sources maps camera names to video sources (camera indices, video
+    files or anything else FrameGrabber accepts). With a port, a small
+    HTTP API is served on host:port:
+        - GET /status:          the state of every camera
+        - GET /events?since=t:  the recognitions after time t (seconds
+                                since the epoch), oldest first
+    """
+
+    def __init__(self, model, sources, host='127.0.0.1', port=8080,
+                 threshold=None, required_frames=5, box_size=(250, 250),
+                 size=(100, 100), max_batch=32, max_delay=0.005, workers=2,
+                 detect=False):
+        self.scorer = BatchScorer(model, max_batch, max_delay, workers)
+        threshold = model.threshold if threshold is None else threshold
+        self.cameras = {name: Camera(name, source, self.scorer, threshold,
+                                     required_frames, box_size, size, detect=detect)
+                        for name, source in sources.items()}
+        self.host = host
+        self.port = port
+
+    def events(self, since=0):
+        events = [e for camera in self.cameras.values() for e in camera.events
+                  if e['time'] > since]
+        return sorted(events, key=lambda e: e['time'])
+
+    def status(self):
+        return {name: camera.status() for name, camera in self.cameras.items()}
+
+    async def _handle(self, reader, writer):
+        """Answers one HTTP request"""
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+
+            # skip the headers
+            while (await reader.readline()).strip():
+                pass
+
+            path, _, query = request[1].partition('?') if len(request) > 1 else ('', '', '')
+            params = dict(p.partition('=')[::2] for p in query.split('&') if p)
+
+            if len(request) < 2 or request[0] != 'GET':
+                code, body = '405 Method Not Allowed', {'error': 'only GET is supported'}
+            elif path == '/status':
+                code, body = '200 OK', self.status()
+            elif path == '/events':
+                code, body = '200 OK', self.events(float(params.get('since', 0)))
+            else:
+                code, body = '404 Not Found', {'error': f'unknown path {path}'}
+
+        except (ValueError, UnicodeDecodeError) as e:
+            code, body = '400 Bad Request', {'error': str(e)}
+
+        data = json.dumps(body).encode()
+        writer.write(f'HTTP/1.1 {code}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(data)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + data)
+        await writer.drain()
+        writer.close()
+
+    async def run(self, stop_when_done=False):
+        """Runs the cameras (and the HTTP API) until cancelled
+
+        With stop_when_done = True, returns once every source has run out
+        of frames, e.g. when the sources are video files.
+        """
+        self.scorer.start()
+        server = None
+        if self.port is not None:
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+            print(f'Serving on http://{self.host}:{self.port}')
+
+        tasks = [asyncio.create_task(camera.run()) for camera in self.cameras.values()]
+        try:
+            # the cameras handle their own errors (see Camera.run), this
+            #   only keeps anything that slips through from stopping the rest
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if not stop_when_done:
+                # keep answering requests after the sources end
+                await asyncio.Event().wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            await self.scorer.stop()
+
+
+def _source(value):
+    """Command line sources are camera indices or video file paths"""
+    return int(value) if value.isdigit() else value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recognize faces from several cameras.')
+    parser.add_argument('--camera', action='append', required=True, metavar='NAME=SOURCE',
+                        help='a camera index or video file, e.g. front=0 or '
+                             'back=recording.mp4 (can be repeated)')
+    parser.add_argument('--model', default='gd_results/model3.faceid')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--required-frames', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--detect', action='store_true',
+                        help='track faces with a Haar cascade instead of a fixed box')
+    args = parser.parse_args()
+
+    sources = dict(camera.split('=', 1) for camera in args.camera)
+    sources = {name: _source(source) for name, source in sources.items()}
+
+    model = Model(artifact_path=args.model)
+    service = Service(model, sources, args.host, args.port,
+                      required_frames=args.required_frames, workers=args.workers,
+                      detect=args.detect)
+
+    try:
+        asyncio.run(service.run())
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt. Exiting program....')
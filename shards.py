@@ -0,0 +1,236 @@
+import os
+import json
+import queue
+import argparse
+import threading
+import numpy as np
+from load_images import load_dataset
+from atomic_file import atomic_write, save_array
+from feature_store import float_rows
+
+# version of the index file layout written by write_shards()
+VERSION = 1
+
+# number of images in each shard
+SHARD_SIZE = 1024
+
+INDEX = 'index.json'
+
+
+def write_shards(images, names, directory, shard_size=SHARD_SIZE, metadata=None):
+    """Splits a dataset into fixed-size .npy shards with an index file
+
+    images is a uint8 array (or memmap) of shape (num. images, ...) and
+    names holds the identity of every image. Shard i holds images
+    i * shard_size to (i + 1) * shard_size in shard_{i}.images.npy and
+    their identity ids in shard_{i}.labels.npy. index.json lists the
+    shards and the identities (plus anything in the metadata dictionary,
+    e.g. where the images came from), and is written last, so a directory
+    with an index always holds a complete dataset.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    names = np.asarray(names)
+    identities, labels = np.unique(names, return_inverse=True)
+    labels = labels.astype(np.int32)
+
+    shards = []
+    for i, start in enumerate(range(0, len(images), shard_size)):
+        stop = min(start + shard_size, len(images))
+        prefix = f'shard_{i:05d}'
+        save_array(os.path.join(directory, f'{prefix}.images.npy'),
+                   np.ascontiguousarray(images[start:stop]))
+        save_array(os.path.join(directory, f'{prefix}.labels.npy'), labels[start:stop])
+        shards.append({'images': f'{prefix}.images.npy',
+                       'labels': f'{prefix}.labels.npy',
+                       'start': start,
+                       'count': stop - start})
+
+    index = {'version': VERSION,
+             'count': len(images),
+             'shape': list(images.shape[1:]),
+             'dtype': str(images.dtype),
+             'identities': identities.tolist(),
+             'shards': shards,
+             'metadata': metadata or {}}
+
+    with atomic_write(os.path.join(directory, INDEX), 'w') as f:
+        json.dump(index, f)
+
+
+def build_shards(folder, directory, size=None, detect=False, shard_size=SHARD_SIZE):
+    """Decodes a dataset folder (see load_dataset) and writes it as shards"""
+    images, names = load_dataset(folder, size=size, mmap_mode='r', detect=detect)
+    write_shards(images, names, directory, shard_size,
+                 metadata={'folder': folder, 'size': size and list(size), 'detect': detect})
+    return ShardedDataset(directory)
+
+
+class ShardedDataset:
+    """A dataset stored as shards by write_shards()
+
+    Opening the dataset only reads the small index file. The pixels are
+    read one shard at a time by iter_shards(), which loads the next
+    prefetch shards on a background thread while the current one is
+    being processed, so the dataset never has to fit in memory and work
+    can start as soon as the first shard is read.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX)) as f:
+            self.index = json.load(f)
+
+        if self.index['version'] > VERSION:
+            raise ValueError(f'{directory} has format version {self.index["version"]}, '
+                             f'only versions up to {VERSION} are supported.')
+
+        self.identities = np.asarray(self.index['identities'], dtype=str)
+        self.shards = self.index['shards']
+        self.metadata = self.index.get('metadata', {})
+        self._labels = None
+
+    def __len__(self):
+        return self.index['count']
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.index['shape'])
+
+    @property
+    def labels(self):
+        """The identity id of every image (the label files are small)"""
+        if self._labels is None:
+            self._labels = np.concatenate([self._load(shard, 'labels')
+                                           for shard in self.shards])
+        return self._labels
+
+    @property
+    def names(self):
+        """The identity of every image, like load_image_names_from_folder()"""
+        return self.identities[self.labels]
+
+    def _load(self, shard, kind, mmap_mode=None):
+        return np.load(os.path.join(self.directory, shard[kind]), mmap_mode=mmap_mode)
+
+    def shard(self, i, mmap_mode=None):
+        """Returns the images and identity ids of shard i"""
+        shard = self.shards[i]
+        return self._load(shard, 'images', mmap_mode), self._load(shard, 'labels')
+
+    def worker_shards(self, worker, num_workers):
+        """Returns the shard numbers that worker (of num_workers) processes"""
+        return list(range(worker, len(self.shards), num_workers))
+
+    def iter_shards(self, shards=None, prefetch=2):
+        """Yields (start, images, labels) for each shard, reading ahead
+
+        shards is the list of shard numbers to read, in order (all of
+        them by default). A background thread reads up to prefetch shards
+        ahead of the one that was last yielded.
+        """
+        shards = range(len(self.shards)) if shards is None else shards
+        loaded = queue.Queue(maxsize=max(1, prefetch))
+        stop = threading.Event()
+
+        def put(item):
+            # gives up once the consumer has stopped, so the thread never
+            #   blocks forever on a full queue nobody reads
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for i in shards:
+                    if not put((self.shards[i]['start'],) + self.shard(i)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = loaded.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def minibatches(self, target_name=None, batch_size=256, shuffle=True, seed=595,
+                    shards=None, prefetch=2):
+        """Creates a source of mini-batches for train_streaming
+
+        Like logistic_regression.minibatches(), but reads the dataset one
+        shard at a time. Every epoch visits the shards in a random order
+        and shuffles the images inside each shard. The labels are 1 for
+        target_name and 0 otherwise, or the identity ids if target_name
+        is None.
+        """
+        shards = list(range(len(self.shards)) if shards is None else shards)
+        target = None
+        if target_name is not None:
+            target = int(np.searchsorted(self.identities, target_name))
+            if target == len(self.identities) or self.identities[target] != target_name:
+                raise ValueError(f'{target_name} is not in the dataset {self.directory}')
+
+        def batches(epoch):
+            rng = np.random.default_rng(seed + epoch)
+            order = list(shards)
+            if shuffle:
+                rng.shuffle(order)
+
+            for _, images, labels in self.iter_shards(order, prefetch):
+                rows = images.reshape((len(images), -1))
+                within = rng.permutation(len(rows)) if shuffle else np.arange(len(rows))
+
+                for start in range(0, len(rows), batch_size):
+                    idx = np.sort(within[start:start + batch_size])
+                    X_batch = float_rows(rows[idx], scale=1 / 255)
+                    if target is None:
+                        Y_batch = labels[idx].reshape((-1, 1))
+                    else:
+                        Y_batch = (labels[idx] == target).astype(int).reshape((-1, 1))
+                    yield X_batch, Y_batch
+
+        return batches
+
+    def predict_proba(self, model, shards=None, prefetch=2):
+        """Scores every image with model, one prefetched shard at a time
+
+        Returns the probabilities of the images in the given shards (all
+        of them by default), in order
+        """
+        shards = range(len(self.shards)) if shards is None else shards
+        probs = [model.predict_proba_batch(images)
+                 for _, images, _ in self.iter_shards(shards, prefetch)]
+        if not probs:
+            return np.empty((0, 1), dtype=np.float32)
+        return np.concatenate(probs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a dataset folder as shards.')
+    parser.add_argument('--folder', default='lfw_data')
+    parser.add_argument('--output', default='lfw_shards')
+    parser.add_argument('--image-size', type=int, default=100)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--detect', action='store_true')
+    args = parser.parse_args()
+
+    dataset = build_shards(args.folder, args.output,
+                           size=(args.image_size, args.image_size),
+                           detect=args.detect, shard_size=args.shard_size)
+    print(f'Wrote {len(dataset)} images in {len(dataset.shards)} shards to {args.output}')
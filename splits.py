@@ -0,0 +1,104 @@
+import random
+import numpy as np
+
+
+def binary_labels(names, target_name):
+    """Converts a list of names into a (num. samples, 1) array of labels
+
+    target name   --> 1
+    otherwise     --> 0
+    """
+    return (np.asarray(names) == target_name).astype(int).reshape((-1, 1))
+
+
+def complement(indices, n):
+    """Returns the indices in range(n) that are not in indices, in order"""
+    mask = np.ones(n, dtype=bool)
+    mask[indices] = False
+    return np.flatnonzero(mask)
+
+
+def balanced_sample(labels, seed=595):
+    """Picks every positive sample and an equal number of negative samples
+
+    labels is an array of 0/1 labels (any shape). The negatives are drawn
+    without replacement using random.Random(seed), which picks the same
+    samples as calling random.seed(seed) followed by random.sample() on
+    the list of negative indices.
+
+    Returns the indices of the positive samples followed by the indices
+    of the sampled negative samples
+    """
+    labels = np.ravel(labels)
+    positives = np.flatnonzero(labels == 1)
+    negatives = np.flatnonzero(labels != 1)
+
+    # random.sample only depends on the population's length, so sampling
+    #   positions in negatives gives the same result as sampling the list
+    picks = random.Random(seed).sample(range(len(negatives)), len(positives))
+
+    return np.concatenate([positives, negatives[picks]])
+
+
+def stratified_split(labels, test_size=0.25, seed=595):
+    """Splits the samples into training and testing sets by class
+
+    Each class is shuffled and split separately, so both sets end up with
+    the same proportion of every class as the full dataset. labels can be
+    0/1 labels or any other array of class ids (e.g. identity ids).
+
+    Returns the training indices and the testing indices
+    """
+    labels = np.ravel(labels)
+    rng = np.random.default_rng(seed)
+
+    train, test = [], []
+    for label in np.unique(labels):
+        indices = np.flatnonzero(labels == label)
+        rng.shuffle(indices)
+
+        n_test = int(np.ceil(len(indices) * test_size))
+        test.append(indices[:n_test])
+        train.append(indices[n_test:])
+
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(test))
+
+
+def holdout_split(labels, test_size=0.25, seed=595):
+    """Splits the samples into a balanced training set and a held-out set
+
+    The training set is balanced_sample() minus a stratified test_size
+    share of it (see stratified_split()). That share and every negative
+    sample balanced_sample() left out are held out, so the held-out set
+    includes target samples the model never saw, and the unlock threshold
+    can be chosen on it. face_id.py trains on the training set and
+    testing.py evaluates on the held-out set, both with this function.
+
+    Returns the training indices and the held-out indices
+    """
+    labels = np.ravel(labels)
+    subset = balanced_sample(labels, seed)
+    train, test = stratified_split(labels[subset], test_size, seed)
+
+    held_out = np.concatenate([subset[test], complement(subset, len(labels))])
+    return np.sort(subset[train]), np.sort(held_out)
+
+
+def kfold_splits(labels, k=5, seed=595):
+    """Yields (training indices, testing indices) for k stratified folds
+
+    The samples of every class are shuffled once and dealt out to the
+    folds in turn, so every fold has about the same proportion of each
+    class. Each sample is in the testing set of exactly one fold.
+    """
+    labels = np.ravel(labels)
+    rng = np.random.default_rng(seed)
+
+    folds = np.empty(len(labels), dtype=int)
+    for label in np.unique(labels):
+        indices = np.flatnonzero(labels == label)
+        rng.shuffle(indices)
+        folds[indices] = np.arange(len(indices)) % k
+
+    for fold in range(k):
+        yield np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
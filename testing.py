@@ -1,14 +1,15 @@
-import logistic_regression as lr 
 from pic_ops import capture_image, crop_image, resize_image
 from clean_up import clean_up
-from load_images import load_images_from_folder, load_image_names_from_folder
+from load_images import load_image_names_from_folder
+from feature_store import FeatureStore
+from model import Model
+from splits import binary_labels, holdout_split
+import evaluation
 import os 
 import numpy as np
 from sklearn.model_selection import train_test_split
 import cv2 
 import credentials as creds
-import random
-import scipy
 
 
 # if the files containing the tuned weight and bias parameters
@@ -16,6 +17,9 @@ import scipy
 w_path = 'gd_results/training_weights3.mat'
 b_path = 'gd_results/training_biases3.mat'
 
+# the model artifact the evaluation report and threshold are saved to
+model_path = 'gd_results/model3.faceid'
+
 trained = True 
 
 image_path = 'lfw_data'
@@ -23,14 +27,9 @@ image_size = (100, 100)
 
 target_name = 'George_W_Bush'
 
-images = load_images_from_folder(image_path, size=image_size)
-
-# convert the list of images into a numpy array
-X = np.stack(images, axis=0)
-
-# flatten and normalize the data
-X = X.reshape((X.shape[0], np.prod(X.shape[1:4])))
-X = X / 255 
+# load the flattened uint8 pixels as a memory-mapped matrix
+# the data is normalized to [0, 1] chunk by chunk inside X.dot()
+X = FeatureStore.from_folder(image_path, size=image_size)
 
 print(f'Shape of data: {X.shape}')
 
@@ -40,33 +39,30 @@ names = load_image_names_from_folder(image_path)
 # convert the names into labels:
 # target name   --> 1
 # otherwise     --> 0
-Y = np.array([1 if name == target_name else 0 for name in names])
-Y = Y.reshape((Y.shape[0], 1))
+Y = binary_labels(names, target_name)
 print(f'Shape of labels: {Y.shape}')
-# # extract the indices corresponding to the target name
-target_indices = [i for i in range(len(names)) if target_name in names[i]]
-others_indices = [i for i in range(len(names)) if i not in target_indices]
 
-random.seed(595)
-others_indices = random.sample(others_indices, len(target_indices))
+# the training subset and the held-out samples the model never saw,
+#   split the same way as in face_id.py
+subset_indices, test_indices = holdout_split(Y, test_size=0.25, seed=595)
 
-test_indices = [i for i in range(len(names)) if i not in target_indices and i not in others_indices]
-# test_indices = random.sample(test_indices, len(target_indices))
-
-subset_indices = target_indices + others_indices 
 X_subset = X[subset_indices]
 Y_subset = Y[subset_indices]
 
-test_subset_indices = target_indices + test_indices 
-X_test_subset = X[test_subset_indices]
-Y_test_subset = Y[test_subset_indices]
+X_test_subset = X[test_indices]
+Y_test_subset = Y[test_indices]
 
 
-w = scipy.io.loadmat(w_path)['weights']
-b = scipy.io.loadmat(b_path)['biases']
+# the trained model, including its preprocessing stage if it has one;
+#   when there is an artifact, evaluate it, since that is the model the
+#   report and threshold are saved to
+if os.path.exists(model_path):
+    model = Model(artifact_path=model_path)
+else:
+    model = Model(w_path, b_path)
 
 #sigmoid with final w and b, fitted to binary 1 or 0 for train data
-A_train = lr.sigmoid(np.dot(X_subset, w) + b)
+A_train = model.predict_proba(X_subset)
 train_predictions = (A_train >= .5).astype(int)
 
 #find accuracy of predictions and print
@@ -75,10 +71,23 @@ train_accuracy = np.mean(train_predictions == Y_subset)
 print(f"Train Set Accuracy: {train_accuracy:.2f}")
 
 #sigmoid with final w and b, fitted to binary 1 or 0 for test data
-A_test = lr.sigmoid(np.dot(X_test_subset, w) + b)
+A_test = model.predict_proba(X_test_subset)
 test_predictions = (A_test >= .5).astype(int)
 
 #find accuracy of predictions and print
 test_accuracy = np.mean(test_predictions == Y_test_subset)
 
-print(f"Test Set Accuracy: {test_accuracy:.2f}")
\ No newline at end of file
+print(f"Test Set Accuracy: {test_accuracy:.2f}")
+
+# accuracy at a 0.5 cutoff says little about a dataset this imbalanced,
+#   so evaluate every threshold on the held-out samples; the threshold
+#   must not be picked on samples the model was trained on, or its
+#   false rejection rate would look better than it is
+report = evaluation.evaluate(A_test, Y_test_subset, max_far=0.01)
+evaluation.print_report(report)
+evaluation.save_report(report, 'evaluation_report.json')
+
+# store the report and the recommended unlock threshold with the model
+if os.path.exists(model_path):
+    evaluation.save_to_artifact(report, model_path)
+    print(f'Saved the threshold {report["threshold"]:.3f} to {model_path}')
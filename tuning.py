@@ -0,0 +1,272 @@
+import os
+import json
+import math
+import random
+import argparse
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import logistic_regression as lr
+from load_images import load_dataset, load_image_names_from_folder
+from feature_store import float_rows
+from atomic_file import atomic_write
+from splits import binary_labels, balanced_sample, stratified_split
+
+# hyperparameters that are searched over by default
+#   a list is a set of choices, a tuple (low, high) is a range that
+#   random search samples on a log scale
+DEFAULT_SPACE = {'solver': ['gd'],
+                 'learning_rate': [0.0001, 0.0005, 0.001, 0.005],
+                 'num_iterations': [15000],
+                 'image_size': [(50, 50), (100, 100)]}
+
+# decision thresholds scored for every trained model, see face_id.py
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def grid_trials(space):
+    """Returns every combination of the choices in space"""
+    keys = list(space)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(space[key] for key in keys))]
+
+
+def random_trials(space, n_trials, seed=595):
+    """Returns n_trials random combinations of the hyperparameters in space
+
+    Choices (lists) are picked uniformly, ranges (tuples) are sampled
+    log-uniformly, which suits scale parameters like the learning rate.
+    """
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(n_trials):
+        trial = {}
+        for key, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                trial[key] = math.exp(rng.uniform(math.log(low), math.log(high)))
+            else:
+                trial[key] = rng.choice(values)
+        trials.append(trial)
+    return trials
+
+
+def score_thresholds(A, Y, thresholds=THRESHOLDS):
+    """Scores predicted probabilities A against labels Y at each threshold
+
+    A face counts as recognized if its probability is at least the
+    threshold, and the score is the accuracy, like in testing.py.
+
+    Returns a dictionary of {threshold: accuracy}
+    """
+    Y = np.ravel(Y)
+    A = np.ravel(A)
+    return {t: float(np.mean((A >= t) == (Y == 1))) for t in thresholds}
+
+
+# the datasets shared with this worker process, see _attach()
+_shared = {}
+
+
+def _attach(datasets, labels, train_indices, valid_indices):
+    """Initializes a worker process with the shared datasets
+
+    datasets maps each image size to the name and shape of a block of
+    shared memory holding the uint8 pixels of the dataset at that size,
+    so the pixels are never pickled or copied between processes.
+    """
+    _shared['labels'] = labels
+    _shared['train'] = train_indices
+    _shared['valid'] = valid_indices
+    _shared['blocks'] = {}
+    _shared['arrays'] = {}
+
+    for size, (name, shape) in datasets.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared['blocks'][size] = block
+        _shared['arrays'][size] = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+
+
+def _features(size):
+    """Returns the float32 training and validation features at size
+
+    They are converted from the shared pixels the first time each size
+    is used by this worker and reused by its later trials.
+    """
+    key = ('features', size)
+    if key not in _shared:
+        X = _shared['arrays'][size]
+        train = float_rows(X[_shared['train']], scale=1 / 255)
+        valid = float_rows(X[_shared['valid']], scale=1 / 255)
+        _shared[key] = (train, valid)
+    return _shared[key]
+
+
+def _run_trial(trial, iterations, init, thresholds):
+    """Trains one trial for iterations more iterations and scores it
+
+    Runs inside a worker process. init holds the parameters reached at
+    the trial's previous rung (or None), so a trial that survives pruning
+    continues where it stopped instead of starting over.
+    """
+    X_train, X_valid = _features(tuple(trial['image_size']))
+    Y = _shared['labels']
+    Y_train, Y_valid = Y[_shared['train']], Y[_shared['valid']]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        params = lr.train(X_train, Y_train,
+                          os.path.join(tmp, 'w.mat'), os.path.join(tmp, 'b.mat'),
+                          solver=trial['solver'],
+                          num_iterations=iterations,
+                          learning_rate=trial['learning_rate'],
+                          init=init)
+
+    A = lr.sigmoid(X_valid.dot(params['w']) + params['b'])
+    return {'w': params['w'],
+            'b': params['b'],
+            'time': params['time'],
+            'scores': score_thresholds(A, Y_valid, thresholds)}
+
+
+def _share(images):
+    """Copies images into a new block of shared memory"""
+    X = images.reshape((images.shape[0], -1))
+    block = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    np.ndarray(X.shape, dtype=np.uint8, buffer=block.buf)[:] = X
+    return block, X.shape
+
+
+def search(folder, target_name, space=DEFAULT_SPACE, n_trials=None,
+           thresholds=THRESHOLDS, rungs=3, eta=3, valid_size=0.25,
+           workers=None, seed=595, leaderboard_path='tuning_results.json'):
+    """Searches for the best hyperparameters and decision threshold
+
+    Every combination of the hyperparameters in space is tried (grid
+    search), or n_trials random combinations if n_trials is given. The
+    data is the same balanced subset face_id.py trains on, split into a
+    training and a held-out validation set with stratified_split().
+
+    Bad trials are pruned early by successive halving: all trials are
+    first trained for num_iterations / eta^(rungs - 1) iterations, only
+    the best 1 / eta of them continue for eta times as many iterations,
+    and so on until the survivors have trained for num_iterations.
+
+    Each model is scored at every threshold in thresholds, so the
+    threshold is tuned without training any extra models. The trials run
+    in a pool of worker processes; the pixels of the dataset at each
+    image size are put in shared memory once and read by every worker.
+
+    The leaderboard (every trial, best first) is written to
+    leaderboard_path as JSON and returned
+    """
+
+    if n_trials:
+        trials = random_trials(space, n_trials, seed)
+    else:
+        trials = grid_trials(space)
+
+    names = load_image_names_from_folder(folder)
+    Y = binary_labels(names, target_name)
+    subset = balanced_sample(Y, seed=seed)
+    train_indices, valid_indices = stratified_split(Y[subset], test_size=valid_size, seed=seed)
+
+    # only the balanced subset is shared, at every requested image size
+    blocks = {}
+    datasets = {}
+    try:
+        for size in sorted({tuple(trial['image_size']) for trial in trials}):
+            images, _ = load_dataset(folder, size=size, mmap_mode='r')
+            blocks[size], shape = _share(images[subset])
+            datasets[size] = (blocks[size].name, shape)
+        labels = Y[subset]
+
+        results = [{'trial': trial, 'iterations': 0, 'time': 0.0, 'status': 'running',
+                    'w': None, 'b': None, 'scores': {}} for trial in trials]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                 initargs=(datasets, labels, train_indices,
+                                           valid_indices)) as pool:
+            alive = list(range(len(results)))
+
+            for rung in range(rungs):
+                # iterations each trial should have trained for after this rung
+                futures = {}
+                for i in alive:
+                    r = results[i]
+                    total = max(1, r['trial']['num_iterations'] // eta ** (rungs - 1 - rung))
+                    init = None if r['w'] is None else {'w': r['w'], 'b': r['b']}
+                    futures[i] = (total, pool.submit(_run_trial, r['trial'],
+                                                     total - r['iterations'], init,
+                                                     thresholds))
+
+                for i, (total, future) in futures.items():
+                    out = future.result()
+                    results[i].update(w=out['w'], b=out['b'], scores=out['scores'],
+                                      iterations=total,
+                                      time=results[i]['time'] + out['time'])
+
+                # keep the best 1 / eta of the trials for the next rung
+                alive.sort(key=lambda i: _best(results[i]['scores']), reverse=True)
+                if rung < rungs - 1:
+                    keep = max(1, math.ceil(len(alive) / eta))
+                    for i in alive[keep:]:
+                        results[i]['status'] = f'pruned at rung {rung}'
+                    alive = alive[:keep]
+
+            for i in alive:
+                results[i]['status'] = 'complete'
+
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    leaderboard = []
+    for r in results:
+        accuracy, threshold = _best(r['scores'])
+        leaderboard.append({**r['trial'],
+                            'threshold': threshold,
+                            'accuracy': accuracy,
+                            'iterations': r['iterations'],
+                            'time': r['time'],
+                            'status': r['status']})
+
+    # complete trials first, then by accuracy
+    leaderboard.sort(key=lambda row: (row['status'] == 'complete', row['accuracy']),
+                     reverse=True)
+
+    if leaderboard_path:
+        with atomic_write(leaderboard_path, 'w') as f:
+            json.dump(leaderboard, f, indent=2)
+        print(f'Wrote leaderboard to {leaderboard_path}')
+
+    return leaderboard
+
+
+def _best(scores):
+    """Returns the best (accuracy, threshold); ties go to the higher threshold"""
+    if not scores:
+        return (0.0, None)
+    return max((accuracy, threshold) for threshold, accuracy in scores.items())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the hyperparameters and '
+                                                 'decision threshold of the classifier.')
+    parser.add_argument('--folder', default='lfw_data')
+    parser.add_argument('--target', default='George_W_Bush')
+    parser.add_argument('--trials', type=int, default=None,
+                        help='number of random trials (default: grid search)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='tuning_results.json')
+    args = parser.parse_args()
+
+    leaderboard = search(args.folder, args.target, n_trials=args.trials,
+                         workers=args.workers, leaderboard_path=args.output)
+
+    for row in leaderboard[:10]:
+        print(f"{row['accuracy']:.3f}  threshold={row['threshold']}  "
+              f"lr={row['learning_rate']:.5g}  size={row['image_size']}  "
+              f"iterations={row['iterations']}  ({row['status']})")